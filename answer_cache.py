@@ -0,0 +1,249 @@
+# Near-duplicate cache for travel assistant answers.
+#
+# Questions are normalized (accents, stop words, a small synonym table, plural endings)
+# into word and word-pair shingles, and each one gets a MinHash signature. Signatures
+# are split into LSH bands, so a lookup only compares against earlier questions that
+# share a band with it; those candidates are then scored by the Jaccard similarity of
+# their shingles, with each word weighted by how rare it is among the cached questions.
+# Negations and named things (capitalized words, acronyms, numbers) must appear in both
+# questions, so "Is it not safe..." never reuses "Is it safe..." and a question about
+# CDG never reuses one about Orly. Everything runs locally, with no embedding service.
+# Entries are kept per namespace (the caller's choice, e.g. destination plus trip
+# context), expire after a TTL and are evicted LRU.
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from gazetteer import normalize_name
+
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.7"))  # minimum weighted Jaccard similarity
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(24 * 60 * 60)))
+ANSWER_CACHE_ENTRIES = int(os.getenv("ANSWER_CACHE_ENTRIES", "2000"))
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 4 rows per band: pairs above ~0.5 similarity almost always share a band
+MIN_QUESTION_TOKENS = 2  # shorter questions are too vague to match safely
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+# Phrases rewritten before tokenizing so common paraphrases of the same question share words
+PHRASE_SYNONYMS = [
+    (re.compile(r"\b(best|ideal|good|right) (time|season|month) (to|for)\b"), "when"),
+    (re.compile(r"\bhow much (does|do|is|are|will)\b"), "cost"),
+    (re.compile(r"\bthings to (do|see)\b"), "sights"),
+    (re.compile(r"\bmust[- ]see\b"), "sights"),
+    (re.compile(r"\b(go|head) to\b"), "visit"),
+]
+# "isn't", "don't", "can't": folded to a separate "not" before accents and punctuation are stripped
+CONTRACTED_NEGATION = re.compile(r"n['’]t\b", re.IGNORECASE)
+NEGATIONS = {
+    "not", "no", "never", "nothing", "none", "nor", "without", "cannot",
+    "dont", "doesnt", "didnt", "isnt", "arent", "wasnt", "werent", "cant", "wont", "shouldnt",
+}
+# Only spellings and word forms of the same word; words that differ in meaning (open/close,
+# lunch/dinner, bus/train) stay distinct so their answers never stand in for each other
+WORD_SYNONYMS = {
+    "visiting": "visit", "visited": "visit",
+    "prices": "price", "priced": "price", "costs": "cost",
+    "tickets": "ticket",
+    "restaurants": "restaurant",
+    "hotels": "hotel",
+    "museums": "museum",
+    "sightseeing": "sights",
+    "theatre": "theater", "theatres": "theater", "centre": "center", "centres": "center",
+    "colour": "color", "colourful": "colorful", "neighbourhood": "neighborhood",
+    "neighbourhoods": "neighborhood", "neighborhoods": "neighborhood", "harbour": "harbor",
+    "favourite": "favorite", "travelling": "traveling", "travellers": "travelers", "traveller": "traveler",
+}
+STOP_WORDS = {
+    "a", "an", "the", "and", "or", "of", "in", "on", "at", "to", "for", "from", "with", "about", "into",
+    "i", "we", "me", "my", "our", "us", "you", "your", "it", "its", "this", "that", "these", "those", "there",
+    "is", "are", "was", "were", "be", "been", "am", "do", "does", "did", "can", "could", "should", "would",
+    "will", "shall", "may", "might", "must", "have", "has", "had", "get", "some", "any", "what", "which",
+    "who", "how", "please", "tell", "know", "like", "want", "need", "really", "very", "just",
+    "also", "here", "if", "so", "much", "many", "more", "most", "let", "lets", "s", "ca", "wo",
+}
+# Plural "s" is left on words like "paris", "bus" and "glass"
+SINGULAR_ENDINGS = ("ss", "is", "us")
+_SENTENCE = re.compile(r"[.!?]+\s+")
+_WORD = re.compile(r"[^\W_]+")
+
+
+# Words that name something specific: capitalized words past the start of a sentence,
+# acronyms and numbers. Two questions that differ in one of these are about different things.
+def named_words(question):
+    named = set()
+    for sentence in _SENTENCE.split(question):
+        for position, word in enumerate(_WORD.findall(sentence)):
+            if (any(c.isdigit() for c in word) or (len(word) > 1 and word.isupper())
+                    or (position > 0 and word[0].isupper())):
+                named.update(normalize_name(word).split())
+    return {fold_word(word) for word in named} - STOP_WORDS
+
+
+# One spelling for each word form: synonyms first, then a trailing plural "s"
+def fold_word(word):
+    word = "not" if word in NEGATIONS else WORD_SYNONYMS.get(word, word)
+    if len(word) > 4 and word.endswith("s") and not word.endswith(SINGULAR_ENDINGS):
+        word = WORD_SYNONYMS.get(word[:-1], word[:-1])
+    return word
+
+
+# Content words of a question after synonyms and plural endings are folded together, and
+# the subset of them (negation, named words) that another question has to share to match
+def normalize_question(question):
+    named = named_words(question)
+    text = normalize_name(CONTRACTED_NEGATION.sub(" not", question))
+    for pattern, replacement in PHRASE_SYNONYMS:
+        text = pattern.sub(replacement, text)
+    tokens = []
+    for word in text.split():
+        if word in STOP_WORDS:
+            continue
+        word = fold_word(word)
+        if word not in tokens:
+            tokens.append(word)
+    required = {word for word in tokens if word == "not" or word in named}
+    return tokens, required
+
+
+# Single words plus adjacent pairs, so words that appear together count for more. Pairs are
+# unordered: "louvre tickets" and "tickets for the louvre" share one.
+def shingles(tokens):
+    return set(tokens) | {" ".join(sorted(pair)) for pair in zip(tokens, tokens[1:])}
+
+
+def weighted_jaccard(a, b, weight):
+    union = sum(weight(s) for s in a | b)
+    return sum(weight(s) for s in a & b) / union if union else 0.0
+
+
+class MinHasher:
+    def __init__(self, num_perm=MINHASH_PERMUTATIONS, seed=1):
+        rng = np.random.default_rng(seed)
+        # Random hash functions h(x) = (a * x + b) mod p; products stay below 2**64
+        self.a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingle_set):
+        hashes = np.array([zlib.crc32(s.encode("utf-8")) for s in shingle_set], dtype=np.uint64)
+        return ((hashes[:, None] * self.a[None, :] + self.b[None, :]) % _MERSENNE_PRIME).min(axis=0)
+
+
+class AnswerCache:
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_ENTRIES,
+                 num_perm=MINHASH_PERMUTATIONS, bands=LSH_BANDS):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._next_id = 0
+        self._entries = OrderedDict()  # id -> entry dict, least recently used first
+        self._buckets = {}  # (namespace, band, band hash) -> ids of entries in that bucket
+        self._document_frequency = Counter()  # word -> number of cached questions using it
+        self._lock = threading.Lock()
+
+    # Bucket keys for a signature in every band
+    def _band_keys(self, namespace, signature):
+        return [(namespace, band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+
+    # Inverse document frequency of a shingle's words: words few cached questions use
+    # (places, dishes, airports) count for more than ones most of them share
+    def _weight(self, shingle):
+        documents = len(self._entries) + 1
+        words = shingle.split()
+        return sum(math.log(documents / (self._document_frequency[word] + 1)) + 1 for word in words) / len(words)
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self._document_frequency.subtract(entry["tokens"])
+        self._document_frequency += Counter()  # drop words no entry uses any more
+        for key in entry["buckets"]:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    # The cached answer for the most similar earlier question in this namespace:
+    # {"answer", "question", "similarity"}, or None when nothing clears the threshold
+    def get(self, namespace, question):
+        tokens, required = normalize_question(question)
+        if len(tokens) < MIN_QUESTION_TOKENS:
+            return None
+        question_tokens = set(tokens)
+        question_shingles = shingles(tokens)
+        band_keys = self._band_keys(normalize_name(namespace), self.hasher.signature(question_shingles))
+        now = time.time()
+        with self._lock:
+            candidates = set()
+            for key in band_keys:
+                candidates |= self._buckets.get(key, set())
+            best, best_similarity = None, 0.0
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry["expires_at"] <= now:
+                    self._remove(entry_id)
+                    continue
+                if not (required <= entry["tokens"] and entry["required"] <= question_tokens):
+                    continue
+                similarity = weighted_jaccard(question_shingles, entry["shingles"], self._weight)
+                if similarity > best_similarity:
+                    best, best_similarity = entry_id, similarity
+            if best is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            entry = self._entries[best]
+            return {"answer": entry["answer"], "question": entry["question"], "similarity": round(best_similarity, 3)}
+
+    def put(self, namespace, question, answer):
+        tokens, required = normalize_question(question)
+        if len(tokens) < MIN_QUESTION_TOKENS or self.max_entries <= 0:
+            return
+        question_shingles = shingles(tokens)
+        band_keys = self._band_keys(normalize_name(namespace), self.hasher.signature(question_shingles))
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {
+                "question": question,
+                "answer": answer,
+                "tokens": set(tokens),
+                "required": required,
+                "shingles": question_shingles,
+                "buckets": band_keys,
+                "expires_at": time.time() + self.ttl,
+            }
+            self._document_frequency.update(tokens)
+            for key in band_keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
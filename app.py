@@ -1,18 +1,60 @@
 import streamlit as st
 import os
 import requests
+import hashlib
 import json
-from io import BytesIO
-from fpdf import FPDF
+from urllib.parse import urlencode
 import folium
 from streamlit_folium import st_folium
-import datetime
+import html
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import google.generativeai as genai
+from folium.plugins import MarkerCluster
+from answer_cache import AnswerCache
+from gazetteer import GAZETTEER_EXTRA_FILE, load_gazetteer
+from geocoding import GEOCODE_DB, GeocodeCache, RateLimitedGeocoder, extract_places
+from resilience import BREAKERS, CLOSED, HALF_OPEN, CircuitOpenError
+from routing import activity_positions, itinerary_distance, optimize_itinerary
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 
 API_URL = "https://wanderai-wd12.onrender.com/api/itinerary"  # Flask API endpoint
+USAGE_URL = API_URL.rsplit("/", 1)[0] + "/usage"  # token usage reporting
 UNSPLASH_API_KEY = os.getenv('UNSPLASH_ACCESS_KEY')
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+APP_API_TOKEN = os.getenv('APP_API_TOKEN', '')  # shared with the backend, which then bills by session
+JOB_POLL_INTERVAL = 1  # seconds between itinerary job status checks
+GENERATION_TIMEOUT = 180  # seconds before giving up on an itinerary job
+
+# How long third-party lookups stay cached (seconds); shared by all sessions
+WEATHER_CACHE_TTL = 10 * 60
+IMAGE_CACHE_TTL = 3 * 24 * 60 * 60
+LOOKUP_CACHE_ENTRIES = 500
+
+# Per-request timeouts (seconds) for the lookups made while the page renders
+WEATHER_TIMEOUT = 5
+IMAGE_TIMEOUT = 8
+GEOCODE_TIMEOUT = 8
+GEMINI_TIMEOUT = 30
+LOOKUP_POOL_SIZE = 16  # pooled connections per host in the shared HTTP session
+ITINERARY_GEOCODE_WAIT = 10  # seconds to wait for new activity places before drawing the map
+# One circuit breaker per third-party service, shared by every session in this process;
+# while one is open its lookups return cached or placeholder data instead of waiting
+WEATHER_BREAKER = BREAKERS.get("openweather", timeout=WEATHER_TIMEOUT)
+IMAGE_BREAKER = BREAKERS.get("unsplash", timeout=IMAGE_TIMEOUT)
+GEMINI_BREAKER = BREAKERS.get("gemini", timeout=GEMINI_TIMEOUT)
+# Travel assistant conversation limits; token counts are estimated at CHARS_PER_TOKEN characters each
+ASSISTANT_MODEL = "gemini-2.5-flash"
+ASSISTANT_HISTORY_TOKENS = 2000  # past turns sent with each question, newest first
+ASSISTANT_CONTEXT_TOKENS = 800  # itinerary summary sent with each question
+ASSISTANT_SUMMARY_TOKENS = 150  # note standing in for turns that no longer fit
+ASSISTANT_MAX_TURNS = 40  # messages kept per session for display
+CHARS_PER_TOKEN = 4
+DAY_COLORS = ["blue", "red", "green", "purple", "orange", "darkred", "cadetblue", "darkgreen", "darkpurple", "pink"]
 
 # Page configuration with custom theme and favicon
 st.set_page_config(
@@ -297,55 +339,110 @@ def estimate_budget(days, travel_style):
     total_cost = (costs["hotel"] + costs["food"] + costs["transport"]) * days
     return total_cost
 
-def get_weather(destination):
-    if not OPENWEATHER_API_KEY:
-        return None, None, None
-        
-    url = f"https://api.openweathermap.org/data/2.5/weather?q={destination}&appid={OPENWEATHER_API_KEY}&units=metric"
-    
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            temp = data["main"]["temp"]
-            weather_desc = data["weather"][0]["description"].capitalize()
-            icon_code = data["weather"][0]["icon"]
-            icon_url = f"http://openweathermap.org/img/wn/{icon_code}@2x.png"
-            return temp, weather_desc, icon_url
-        else:
-            return None, None, None
-    except Exception:
-        return None, None, None
+# Lookups are keyed on the lower-cased, whitespace-collapsed destination so "Paris " and "paris" share a cache entry
+def normalize_place(destination):
+    return " ".join(destination.split()).lower()
 
-# Sidebar for user input with better organization
-with st.sidebar:
-    st.markdown('<h3 style="color:#3a7bd5;font-weight:700;margin-bottom:20px;"> Plan Your Trip</h3>', unsafe_allow_html=True)
-    
-    destination = st.text_input("📍 Destination", "Paris")
-    
-    col1, col2 = st.columns(2)
-    with col1:
-        num_days = st.slider(" Days", 1, 10, 3)
-    with col2:
-        travel_style = st.selectbox(" Budget Level", ["Economical", "Mid-Range", "Luxury"])
-    
-    transport = st.selectbox(" Transport", ["Public Transport", "Car Rental", "Walking"])
-    
-    # Budget estimation with better styling
-    estimated_cost = estimate_budget(num_days, travel_style)
-    st.markdown("""
-    <div class="budget-panel">
-        <h4 style="margin:0;color:#2c3e50;font-weight:700;"> Budget Estimate</h4>
-        <p style="margin:10px 0 0 0;">For {} days in {} ({} style):</p>
-        <p style="font-size:1.8rem;font-weight:700;margin:5px 0;color:#2c3e50;">${}
-    </div>
-    """.format(num_days, destination, travel_style.lower(), estimated_cost), unsafe_allow_html=True)
-    
-    # Fetch and Display Weather with better styling
-    temp, weather_desc, icon_url = get_weather(destination)
+# Identifies this browser session to the backend, which meters token usage per session; the
+# backend only trusts the id alongside the app's token
+def client_headers():
+    headers = {"X-Client-Id": st.session_state.setdefault("client_id", uuid.uuid4().hex)}
+    if APP_API_TOKEN:
+        headers["X-App-Token"] = APP_API_TOKEN
+    return headers
+
+# One pooled HTTP session shared by all lookups, sessions and worker threads
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=LOOKUP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# GET a JSON document through a service's circuit breaker, within its timeout
+def get_json(breaker, url, **kwargs):
+    def fetch():
+        response = get_http_session().get(url, timeout=breaker.timeout, **kwargs)
+        response.raise_for_status()
+        return response.json()
+    return breaker.call(fetch)
+
+# Last successful result of each lookup, served while its service is failing
+@st.cache_resource
+def get_last_good_lookups():
+    return {}
+
+# Failed lookups raise instead of returning, so errors are never cached
+@st.cache_data(ttl=WEATHER_CACHE_TTL, max_entries=LOOKUP_CACHE_ENTRIES, show_spinner=False)
+def fetch_weather(place):
+    url = f"https://api.openweathermap.org/data/2.5/weather?q={place}&appid={OPENWEATHER_API_KEY}&units=metric"
+    data = get_json(WEATHER_BREAKER, url)
+    temp = data["main"]["temp"]
+    weather_desc = data["weather"][0]["description"].capitalize()
+    icon_code = data["weather"][0]["icon"]
+    icon_url = f"http://openweathermap.org/img/wn/{icon_code}@2x.png"
+    return temp, weather_desc, icon_url
+
+# Search Unsplash for a destination photo; returns None when there are no results
+@st.cache_data(ttl=IMAGE_CACHE_TTL, max_entries=LOOKUP_CACHE_ENTRIES, show_spinner=False)
+def search_destination_image(place):
+    url = f"https://api.unsplash.com/search/photos?query={place}&client_id={UNSPLASH_API_KEY}&per_page=1"
+    results = get_json(IMAGE_BREAKER, url)["results"]
+    return results[0]["urls"]["regular"] if results else None
+
+# Offline city index, loaded once per process
+@st.cache_resource
+def get_gazetteer():
+    return load_gazetteer()
+
+# Process-wide Nominatim client: persistent cache in front of a rate-limited request queue
+@st.cache_resource
+def get_geocoder():
+    return RateLimitedGeocoder(GeocodeCache(GEOCODE_DB))
+
+# Answers to earlier questions, shared by every session and matched by similarity per destination
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache()
+
+# Look up a destination's coordinates with Nominatim; returns None when nothing matches
+def geocode_destination(place):
+    return get_geocoder().geocode(place, timeout=GEOCODE_TIMEOUT)
+
+# Resolve a destination from the offline index; Nominatim is only asked about places it
+# doesn't know, and what it finds is added to the index for next time
+def locate_destination(destination):
+    gazetteer = get_gazetteer()
+    place = gazetteer.lookup(destination)
+    if place is not None:
+        return place["lat"], place["lon"]
+    location = geocode_destination(normalize_place(destination))
+    if location is not None:
+        gazetteer.add(destination, *location, path=GAZETTEER_EXTRA_FILE)
+    return location
+
+# Start the weather, image and geocode lookups at once; returns {future: lookup name}.
+# Page render then waits on the slowest lookup instead of all three in turn.
+def start_lookups(destination):
+    place = normalize_place(destination)
+    ctx = get_script_run_ctx()
+    # Worker threads carry this run's context so the cached functions can run on them
+    pool = ThreadPoolExecutor(max_workers=3, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+    lookups = {pool.submit(locate_destination, destination): "map"}
+    if OPENWEATHER_API_KEY:
+        lookups[pool.submit(fetch_weather, place)] = "weather"
+    if UNSPLASH_API_KEY:
+        lookups[pool.submit(search_destination_image, place)] = "image"
+    pool.shutdown(wait=False)
+    return lookups
+
+# Fill the sidebar weather card; weather is (temp, description, icon URL) or None
+def render_weather(slot, destination, weather):
+    temp, weather_desc, icon_url = weather or (None, None, None)
     
-    if temp and weather_desc:
-        st.markdown("""
+    if temp is not None and weather_desc:
+        slot.markdown("""
         <div class="weather-card">
             <h4 style="margin:0;color:white;font-weight:700;">🌤 Weather in {}</h4>
             <div style="display:flex;align-items:center;margin-top:10px;">
@@ -360,99 +457,291 @@ with st.sidebar:
         </div>
         """.format(destination, icon_url, temp, weather_desc), unsafe_allow_html=True)
     else:
-        st.markdown("""
+        slot.markdown("""
         <div style="background-color:#f0f4f9;padding:15px;border-radius:8px;margin-top:20px;text-align:center;">
             <p>⚠️ Weather data not available.</p>
         </div>
         """, unsafe_allow_html=True)
-    
-    # Generate button
-    generate_button = st.button("✨ Generate Itinerary")
 
-# Fetch an image for the destination
-def fetch_destination_image(destination):
-    if not UNSPLASH_API_KEY:
-        return None
-    url = f"https://api.unsplash.com/search/photos?query={destination}&client_id={UNSPLASH_API_KEY}&per_page=1"
-    try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise exception for HTTP errors
-        if response.json()["results"]:
-            return response.json()["results"][0]["urls"]["regular"]
-        else:
+# Fill the destination image slot
+def render_destination_image(slot, destination, image_url, error=None):
+    with slot.container():
+        if error is not None:
+            st.warning(f"Failed to fetch image: {error}")
+        elif image_url is None and UNSPLASH_API_KEY:
             st.warning(f"No images found for {destination}")
-            return None
-    except Exception as e:
-        st.warning(f"Failed to fetch image: {e}")
-        return None
+        if image_url:
+            st.image(image_url, caption=f"{destination}", use_container_width=True)
+        else:
+            st.markdown("""
+            <div style="background:linear-gradient(135deg, #e6e9f0 0%, #eef1f5 100%);height:300px;border-radius:12px;display:flex;align-items:center;justify-content:center;">
+                <p style="color:#7f8fa4;font-size:1.2rem;">No image available for {}</p>
+            </div>
+            """.format(destination), unsafe_allow_html=True)
+
+# Function to generate a map with better styling
+def build_map(destination, location):
+    lat, lon = location
+    
+    m = folium.Map(location=[lat, lon], zoom_start=13)
+    folium.Marker(
+        [lat, lon],
+        popup=f"<b>{destination}</b>",
+        tooltip=destination,
+        icon=folium.Icon(color="blue", icon="info-sign")
+    ).add_to(m)
+    
+    # Add a circle to highlight the area
+    folium.Circle(
+        location=[lat, lon],
+        radius=2000,  # 2km radius
+        color="#3a7bd5",
+        fill=True,
+        fill_color="#3a7bd5",
+        fill_opacity=0.2
+    ).add_to(m)
+    
+    return m
+
+# Fill the map slot from the geocode lookup
+def render_map(slot, destination, location, error=None):
+    with slot.container():
+        if error is not None:
+            st.error(f"Error creating map: {error}")
+        elif location is None:
+            st.error(f"Error creating map: no location found for {destination}")
+        if location is None:
+            st.warning("No map to display")
+            return
+        try:
+            st_folium(build_map(destination, location), width=None, height=350)
+        except Exception as e:
+            st.error(f"Error displaying map: {e}")
+
+# Sidebar for user input with better organization
+with st.sidebar:
+    st.markdown('<h3 style="color:#3a7bd5;font-weight:700;margin-bottom:20px;"> Plan Your Trip</h3>', unsafe_allow_html=True)
+    
+    # Trip inputs are committed together when the form is submitted, so typing a destination
+    # or moving the slider doesn't rerun the page on every change
+    with st.form("trip_form", border=False):
+        destination = st.text_input("📍 Destination", "Paris")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            num_days = st.slider(" Days", 1, 21, 3)
+        with col2:
+            travel_style = st.selectbox(" Budget Level", ["Economical", "Mid-Range", "Luxury"])
+
+        transport = st.selectbox(" Transport", ["Public Transport", "Car Rental", "Walking"])
+
+        # Update refreshes the budget, weather, image and map; Generate also plans the trip
+        st.form_submit_button("🔍 Update")
+        generate_button = st.form_submit_button("✨ Generate Itinerary")
+    lookups = start_lookups(destination)
+    
+    # Budget estimation with better styling
+    estimated_cost = estimate_budget(num_days, travel_style)
+    st.markdown("""
+    <div class="budget-panel">
+        <h4 style="margin:0;color:#2c3e50;font-weight:700;"> Budget Estimate</h4>
+        <p style="margin:10px 0 0 0;">For {} days in {} ({} style):</p>
+        <p style="font-size:1.8rem;font-weight:700;margin:5px 0;color:#2c3e50;">${}
+    </div>
+    """.format(num_days, destination, travel_style.lower(), estimated_cost), unsafe_allow_html=True)
+    
+    # Weather card is filled in once its lookup finishes
+    weather_slot = st.empty()
 
 # Main content area
 # Create columns for better layout
 col1, col2 = st.columns([2, 1])
 
 with col1:
-    # Display destination image with better styling
-    image_url = fetch_destination_image(destination)
-    if image_url:
-        st.image(image_url, caption=f"{destination}", use_container_width=True)
-    else:
-        st.markdown("""
-        <div style="background:linear-gradient(135deg, #e6e9f0 0%, #eef1f5 100%);height:300px;border-radius:12px;display:flex;align-items:center;justify-content:center;">
-            <p style="color:#7f8fa4;font-size:1.2rem;">No image available for {}</p>
-        </div>
-        """.format(destination), unsafe_allow_html=True)
+    # Destination image shows a placeholder until its lookup finishes
+    image_slot = st.empty()
+    image_slot.markdown("""
+    <div style="background:linear-gradient(135deg, #e6e9f0 0%, #eef1f5 100%);height:300px;border-radius:12px;display:flex;align-items:center;justify-content:center;">
+        <p style="color:#7f8fa4;font-size:1.2rem;">Loading image for {}…</p>
+    </div>
+    """.format(destination), unsafe_allow_html=True)
 
 with col2:
-    # Function to generate a map with better styling
-    def display_map(destination):
-        headers = {
-            "User-Agent": "AI-Travel-Planner/1.0 (garimaabhayanaa@gmail.com)"
-        }
-        location_url = f"https://nominatim.openstreetmap.org/search?format=json&q={destination}"
-        
-        try:
-            response = requests.get(location_url, headers=headers)
-            
-            if response.status_code == 200 and response.json():
-                lat = float(response.json()[0]["lat"])
-                lon = float(response.json()[0]["lon"])
-                
-                m = folium.Map(location=[lat, lon], zoom_start=13)
-                folium.Marker(
-                    [lat, lon],
-                    popup=f"<b>{destination}</b>",
-                    tooltip=destination,
-                    icon=folium.Icon(color="blue", icon="info-sign")
-                ).add_to(m)
-                
-                # Add a circle to highlight the area
-                folium.Circle(
-                    location=[lat, lon],
-                    radius=2000,  # 2km radius
-                    color="#3a7bd5",
-                    fill=True,
-                    fill_color="#3a7bd5",
-                    fill_opacity=0.2
-                ).add_to(m)
-                
-                return m
+    st.markdown('<h3 class="subheader">📍 Destination Map</h3>', unsafe_allow_html=True)
+    map_slot = st.empty()
+    map_slot.info("Locating destination…")
+
+# Lookups without an API key fall back right away; the rest fill in as they finish
+if not OPENWEATHER_API_KEY:
+    render_weather(weather_slot, destination, None)
+if not UNSPLASH_API_KEY:
+    render_destination_image(image_slot, destination, None)
+last_good = get_last_good_lookups()
+for future in as_completed(lookups):
+    name = lookups[future]
+    key = (name, normalize_place(destination))
+    try:
+        result, error = future.result(), None
+        last_good[key] = result
+        if len(last_good) > LOOKUP_CACHE_ENTRIES:
+            last_good.pop(next(iter(last_good)))
+    except Exception as e:
+        result = last_good.get(key)
+        error = None if result is not None else e
+    if name == "weather":
+        render_weather(weather_slot, destination, result)
+    elif name == "image":
+        render_destination_image(image_slot, destination, result, error)
+    else:
+        render_map(map_slot, destination, result, error)
+
+# Health of the external services this page depends on
+with st.sidebar:
+    with st.expander("🩺 Service status"):
+        for name, state in sorted(BREAKERS.snapshot().items()):
+            if state["state"] == CLOSED:
+                st.markdown(f"🟢 **{name}**: OK")
+            elif state["state"] == HALF_OPEN:
+                st.markdown(f"🟡 **{name}**: recovering, testing with one request")
             else:
-                st.error(f"Error creating map: {response.status_code} - {response.reason}")
-                return None
-        except Exception as e:
-            st.error(f"Error creating map: {e}")
-            return None
+                st.markdown(f"🔴 **{name}**: unavailable after {state['consecutive_failures']} failures, "
+                            f"retrying in {state['retry_after']:.0f}s")
+        answers = get_answer_cache().stats()
+        st.caption(f"Assistant answer cache: {answers['entries']} answers, "
+                   f"{answers['hit_rate']:.0%} of {answers['hits'] + answers['misses']} questions answered from it")
 
-    st.markdown('<h3 class="subheader">📍 Destination Map</h3>', unsafe_allow_html=True)
-    map_object = display_map(destination)
+# Map every place the itinerary mentions, one toggleable layer per day. Markers are
+# clustered so trips with hundreds of stops stay responsive in the browser.
+def build_itinerary_map(itinerary, stops, center):
+    m = folium.Map(location=list(center), zoom_start=12)
+    days = {}
+    groups = {}
+    for stop in stops:
+        if stop["day"] not in days:
+            groups[stop["day"]] = folium.FeatureGroup(name=str(stop["day_label"])).add_to(m)
+            days[stop["day"]] = MarkerCluster().add_to(groups[stop["day"]])
+        color = DAY_COLORS[(stop["day"] - 1) % len(DAY_COLORS)]
+        folium.Marker(
+            [stop["lat"], stop["lon"]],
+            popup=folium.Popup(f"<b>{html.escape(stop['place'])}</b><br>{html.escape(str(stop['day_label']))}, "
+                               f"{html.escape(str(stop['time']))}", max_width=250),
+            tooltip=stop["place"],
+            icon=folium.Icon(color=color, icon="info-sign")
+        ).add_to(days[stop["day"]])
+    # Each day's route through its activities, in itinerary order
+    for number, positions in enumerate(activity_positions(itinerary, stops), start=1):
+        route = [list(position) for position in positions if position is not None]
+        if number in groups and len(route) > 1:
+            color = DAY_COLORS[(number - 1) % len(DAY_COLORS)]
+            folium.PolyLine(route, color=color, weight=3, opacity=0.7).add_to(groups[number])
+    if stops:
+        m.fit_bounds([[min(s["lat"] for s in stops), min(s["lon"] for s in stops)],
+                      [max(s["lat"] for s in stops), max(s["lon"] for s in stops)]])
+    folium.LayerControl(collapsed=False).add_to(m)
+    return m
 
-    if map_object:
-        try:
-            st_folium(map_object, width=None, height=350)
-        except Exception as e:
-            st.error(f"Error displaying map: {e}")
+# Runs as a fragment: interacting with the map section reruns only this function
+@st.fragment
+def render_itinerary_map(itinerary, destination):
+    stops = extract_places(itinerary, destination)
+    try:
+        center = locate_destination(destination)
+    except Exception:
+        center = None
+    if not stops or center is None:
+        st.info("No places to show on the map for this itinerary.")
+        return
+    with st.spinner("Locating places..."):
+        locations, pending = get_geocoder().geocode_many(
+            {stop["place"] for stop in stops}, near=center, timeout=ITINERARY_GEOCODE_WAIT
+        )
+    located = [dict(stop, lat=locations[stop["place"]][0], lon=locations[stop["place"]][1])
+               for stop in stops if stop["place"] in locations]
+    if pending:
+        st.caption(f"Still locating {pending} places; they will appear when the page next refreshes.")
+    try:
+        # Map interactions don't need to rerun the script
+        st_folium(build_itinerary_map(itinerary, located, center), width=None, height=450, returned_objects=[])
+    except Exception as e:
+        st.error(f"Error displaying map: {e}")
+
+    # Reorder each day's activities to cut down on zig-zagging across the city
+    report = st.session_state.get("route_report")
+    if report:
+        st.caption(f"Routes optimized: estimated travel {report['before_km']:.1f} km → {report['after_km']:.1f} km")
     else:
-        st.warning("No map to display")
+        st.caption(f"Estimated travel between activities: {itinerary_distance(itinerary, located)['total_km']:.1f} km")
+    if located and st.button("🧭 Optimize daily routes"):
+        optimized, report = optimize_itinerary(itinerary, located)
+        # Save the new order so server-side exports match what is shown
+        if "itinerary_id" in st.session_state:
+            try:
+                requests.put(f"{API_URL}/{st.session_state['itinerary_id']}", json={"itinerary": optimized},
+                             headers=client_headers(), timeout=10)
+            except requests.RequestException as e:
+                st.warning(f"Could not save the new order: {e}")
+        st.session_state["itinerary"] = optimized
+        st.session_state["route_report"] = report
+        # The new order changes the whole itinerary section, not just the map
+        st.rerun()
+
+# HTML for one itinerary day, given as a dictionary or a bare label. Model output is
+# escaped because it is rendered with unsafe_allow_html.
+def day_html(day, label=None):
+    if not isinstance(day, dict):
+        return f'<div class="day-header"><h3>{html.escape(str(day))}</h3></div>'
+    escape = lambda value: html.escape(str(value))
+    parts = [
+        f'<div class="day-header"><h3>{escape(label if label is not None else day.get("day", ""))}</h3></div>',
+        '<div class="card">',
+        f'<div class="col-md-6"><p><strong> Budget:</strong> ${escape(day.get("budget", "N/A"))}</p></div>',
+        f'<div class="col-md-6"><p><strong> Transport:</strong> {escape(day.get("transport", "N/A"))}</p></div>',
+        '</div>',
+    ]
+    if isinstance(day.get("activities"), list):
+        for activity in day["activities"]:
+            if isinstance(activity, dict):
+                parts.append(f'<div class="activity-item"><strong>{escape(activity.get("time", ""))}</strong>: '
+                             f'{escape(activity.get("activity", ""))}</div>')
+    return "".join(parts)
+
+# The whole itinerary as one HTML block, built in a single pass and memoized on the
+# itinerary's content, so a rerun sends one markdown element instead of one per activity
+@st.cache_data(max_entries=64, show_spinner=False)
+def itinerary_html(itinerary):
+    if isinstance(itinerary, dict):
+        return "".join(day_html(info, label) for label, info in itinerary.items())
+    return "".join(day_html(day) for day in itinerary)
+
+# Picking a day or typing an instruction reruns only this fragment; a successful
+# regeneration reruns the page so every section shows the new itinerary
+@st.fragment
+def regenerate_controls(itinerary):
+    with st.expander("🔄 Not happy with a day? Regenerate just that part"):
+        regen_day = st.selectbox("Day", list(range(1, len(itinerary) + 1)), format_func=lambda n: f"Day {n}")
+        regen_slot = st.selectbox("Activity", ["Whole day", "Morning", "Afternoon", "Evening"])
+        regen_instruction = st.text_input("What should change? (optional)", placeholder="E.g., more outdoor activities")
+        if st.button("Regenerate"):
+            with st.spinner("Regenerating..."):
+                try:
+                    response = requests.post(
+                        f"{API_URL}/{st.session_state['itinerary_id']}/regenerate",
+                        json={
+                            "day": regen_day,
+                            "slot": None if regen_slot == "Whole day" else regen_slot,
+                            "instruction": regen_instruction,
+                        },
+                        headers=client_headers(),
+                        timeout=60,
+                    )
+                    if response.status_code == 200:
+                        st.session_state["itinerary"] = response.json()["itinerary"]
+                        st.session_state.pop("route_report", None)
+                        st.rerun()
+                    else:
+                        st.error(f"❌ Failed to regenerate: {response.json().get('error', response.reason)}")
+                except Exception as e:
+                    st.error(f"❌ Error: {str(e)}")
 
 # Generate Itinerary
 if generate_button:
@@ -465,22 +754,52 @@ if generate_button:
             "transport": transport
         }
         
+        # Days are shown here as the job reports them, then replaced by the full itinerary below
+        preview = st.empty()
         try:
-            response = requests.post(f"{API_URL}/generate", json=user_input, timeout=30)
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                # Check if the response contains the itinerary key
-                if "itinerary" in response_data:
-                    itinerary = response_data["itinerary"] 
-                else:
-                    itinerary = response_data  # Fallback in case structure changes
-                st.session_state["itinerary"] = itinerary
+            response = requests.post(f"{API_URL}/generate", json={**user_input, "async": True},
+                                     headers=client_headers(), timeout=10)
+            if response.status_code == 503:
+                raise Exception("the planner is busy right now, please try again in a few seconds")
+            if response.status_code in (422, 429):
+                # Out of tokens for this request or this session
+                raise Exception(response.json().get("error", response.reason))
+            if response.status_code != 202:
+                raise Exception(f"{response.status_code} - {response.reason}")
+            job_url = f"{API_URL}/jobs/{response.json()['job_id']}"
+
+            days = []
+            deadline = time.monotonic() + GENERATION_TIMEOUT
+            preview_html = ""
+            while True:
+                job = requests.get(job_url, params={"since": len(days)}, timeout=10).json()
+                if job.get("partial"):
+                    days.extend(job["partial"])
+                    preview_html += "".join(day_html(day) for day in job["partial"])
+                    preview.markdown(preview_html, unsafe_allow_html=True)
+                if job["status"] == "done":
+                    days = job["result"]["itinerary"]
+                    st.session_state["itinerary_id"] = job["result"]["id"]
+                    requested_days = job["result"].get("requested_days")
+                    break
+                if job["status"] == "failed":
+                    raise Exception(job.get("error", "generation failed"))
+                if time.monotonic() > deadline:
+                    raise Exception("generation is taking too long, please try again")
+                time.sleep(JOB_POLL_INTERVAL)
+            preview.empty()
+
+            if days:
+                st.session_state["itinerary"] = days
+                st.session_state.pop("route_report", None)
                 st.success(" Your itinerary has been successfully generated!")
+                if requested_days:
+                    st.info(f"Planned {len(days)} of the {requested_days} days you asked for to stay within the token budget.")
             else:
-                st.error(f"❌ Failed to generate itinerary: {response.status_code} - {response.reason}")
+                st.error("❌ Failed to generate itinerary: no days were returned")
         except Exception as e:
-            st.error(f"❌ Error: {str(e)}")
+            preview.empty()
+            st.error(f"❌ Failed to generate itinerary: {str(e)}")
 
 # Display the itinerary with improved styling
 if "itinerary" in st.session_state:
@@ -488,107 +807,9 @@ if "itinerary" in st.session_state:
 
     st.markdown('<h2 class="subheader">✈️ Your Itinerary</h2>', unsafe_allow_html=True)
     
-    # Function to generate PDF - Fixed for Unicode support
-    def generate_pdf(itinerary):
-        pdf = FPDF()
-        pdf.set_auto_page_break(auto=True, margin=15)
-        pdf.add_page()
-        pdf.set_font("Arial", "B", 16)
-        pdf.cell(200, 10, f"Travel Itinerary: {destination}", ln=True, align="C")
-        pdf.cell(200, 10, f"({num_days} days, {travel_style} style)", ln=True, align="C")
-        
-        # Add current date
-        pdf.set_font("Arial", "", 10)
-        current_date = datetime.datetime.now().strftime("%B %d, %Y")
-        pdf.cell(200, 10, f"Generated on: {current_date}", ln=True, align="C")
-        
-        pdf.set_font("Arial", "", 12)
-        
-        # Helper function to sanitize text for PDF generation
-        def sanitize(text):
-            if not isinstance(text, str):
-                text = str(text)
-            # Replace problematic characters with ASCII equivalents
-            # Replace bullet point with hyphen to avoid Unicode issues
-            text = text.replace("•", "-")
-            text = text.replace("'", "'")
-            text = text.replace(""", "\"")
-            text = text.replace(""", "\"")
-            text = text.replace("–", "-")
-            text = text.replace("—", "-")
-            text = text.replace("…", "...")
-            # Replace any other non-ASCII characters
-            return "".join(c if ord(c) < 128 else "-" for c in text)
-        
-        if isinstance(itinerary, list):
-            for day in itinerary:
-                pdf.ln(10)
-                # Handle both string and dictionary days
-                if isinstance(day, dict):
-                    pdf.set_font("Arial", "B", 14)
-                    pdf.cell(200, 10, sanitize(day["day"]), ln=True, align="L")
-                    
-                    pdf.set_font("Arial", "B", 12)
-                    pdf.cell(200, 10, f"Budget: {sanitize(day.get('budget', 'N/A'))}", ln=True, align="L")
-                    pdf.cell(200, 10, f"Transport: {sanitize(day.get('transport', 'N/A'))}", ln=True, align="L")
-                    
-                    pdf.set_font("Arial", "", 12)
-                    pdf.ln(5)
-                    if "activities" in day:
-                        for activity in day["activities"]:
-                            activity_str = f"- {sanitize(activity['time'])}: {sanitize(activity['activity'])}"
-                            # Split long lines to fit the width
-                            pdf.multi_cell(0, 10, activity_str)
-                            pdf.ln(2)
-                else:
-                    # If day is a string
-                    pdf.set_font("Arial", "B", 14)
-                    pdf.cell(200, 10, sanitize(str(day)), ln=True, align="L")
-        elif isinstance(itinerary, dict):
-            for day_key, day_info in itinerary.items():
-                pdf.ln(10)
-                pdf.set_font("Arial", "B", 14)
-                pdf.cell(200, 10, sanitize(day_key), ln=True, align="L")
-                
-                if isinstance(day_info, dict):
-                    pdf.set_font("Arial", "B", 12)
-                    pdf.cell(200, 10, f"Budget: {sanitize(day_info.get('budget', 'N/A'))}", ln=True, align="L")
-                    pdf.cell(200, 10, f"Transport: {sanitize(day_info.get('transport', 'N/A'))}", ln=True, align="L")
-                    
-                    pdf.set_font("Arial", "", 12)
-                    pdf.ln(5)
-                    if "activities" in day_info:
-                        for activity in day_info["activities"]:
-                            activity_str = f"- {sanitize(activity['time'])}: {sanitize(activity['activity'])}"
-                            # Split long lines to fit the width
-                            pdf.multi_cell(0, 10, activity_str)
-                            pdf.ln(2)
-        
-        # Create a BytesIO object to store the PDF
-        pdf_output = BytesIO()
-        # Get the PDF data
-        pdf_data = pdf.output(dest='S')
-        # Check the type and ensure we have bytes
-        if isinstance(pdf_data, str):
-            pdf_bytes = pdf_data.encode('latin-1')
-        else:
-            pdf_bytes = pdf_data    
-        # Write to BytesIO
-        pdf_output.write(pdf_bytes)
-        # Reset the pointer to the start of the BytesIO object
-        pdf_output.seek(0)
-        return pdf_output.getvalue()
-
     # Generate download files
     itinerary_json = json.dumps(itinerary, indent=4)
     
-    try:
-        itinerary_pdf = generate_pdf(itinerary)
-        pdf_error = None
-    except Exception as e:
-        itinerary_pdf = None
-        pdf_error = str(e)
-    
     # Download buttons
     st.markdown("""
     <div style="display:flex;justify-content:center;margin:25px 0 35px 0;">
@@ -601,67 +822,27 @@ if "itinerary" in st.session_state:
             data=itinerary_json,
             file_name=f"{destination}_itinerary.json",
             mime="application/json",
-            use_container_width=True
+            use_container_width=True,
+            on_click="ignore"  # downloading doesn't change anything on the page
         )
     with col2:
-        if itinerary_pdf:
-            st.download_button(
-                label=" Download as PDF",
-                data=itinerary_pdf,
-                file_name=f"{destination}_itinerary.pdf",
-                mime="application/pdf",
-                use_container_width=True
-            )
+        # The backend renders the PDF once per itinerary version and caches it, so reruns cost nothing
+        if "itinerary_id" in st.session_state:
+            pdf_url = f"{API_URL}/{st.session_state['itinerary_id']}.pdf?{urlencode({'style': travel_style})}"
+            st.link_button(" Download as PDF", pdf_url, use_container_width=True)
         else:
-            st.error(f"Could not generate PDF: {pdf_error}")
+            st.info("PDF download is available for saved itineraries.")
+    
+    # Regenerate a single day or activity without redoing the whole trip
+    if "itinerary_id" in st.session_state and isinstance(itinerary, list):
+        regenerate_controls(itinerary)
     
-    # Display itinerary with improved styling
     if isinstance(itinerary, list):
-        # If itinerary is a list of dictionary days
-        for day in itinerary:
-            if isinstance(day, dict):
-                st.markdown(f'''
-                <div class="day-header"><h3>{day["day"]}</h3></div>
-                <div class="card">
-                    <div class="col-md-6">
-                        <p><strong> Budget:</strong> ${day.get('budget', 'N/A')}</p>
-                    </div>
-                    <div class="col-md-6">
-                        <p><strong> Transport:</strong> {day.get('transport', 'N/A')}</p>
-                    </div>
-                </div>
-                ''', unsafe_allow_html=True)
-                if "activities" in day and isinstance(day["activities"], list):
-                    for activity in day["activities"]:
-                        st.markdown(f"""
-                        <div class="activity-item">
-                            <strong>{activity['time']}</strong>: {activity['activity']}
-                        </div>
-                        """, unsafe_allow_html=True)
-            elif isinstance(day, str):
-                # If day is just a string
-                st.markdown(f'<div class="day-header"><h3>{day}</h3></div>', unsafe_allow_html=True)
-    elif isinstance(itinerary, dict):
-        # If itinerary is a dictionary with days as keys
-        for day_key, day_info in itinerary.items():
-            st.markdown(f'<div class="day-header"><h3>{day_key}</h3></div>', unsafe_allow_html=True)
-            
-            if isinstance(day_info, dict):
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.markdown(f"** Budget:** ${day_info.get('budget', 'N/A')}")
-                with col2:
-                    st.markdown(f"** Transport:** {day_info.get('transport', 'N/A')}")
-                
-                st.markdown('<div class="card">', unsafe_allow_html=True)
-                if "activities" in day_info and isinstance(day_info["activities"], list):
-                    for activity in day_info["activities"]:
-                        st.markdown(f"""
-                        <div class="activity-item">
-                            <strong>{activity['time']}</strong>: {activity['activity']}
-                        </div>
-                        """, unsafe_allow_html=True)
-                st.markdown('</div>', unsafe_allow_html=True)
+        st.markdown('<h3 class="subheader">🗺️ Itinerary Map</h3>', unsafe_allow_html=True)
+        render_itinerary_map(itinerary, destination)
+    
+    # Display itinerary with improved styling
+    st.markdown(itinerary_html(itinerary), unsafe_allow_html=True)
 
 # AI Travel Assistant with improved styling
 st.markdown('<h2 class="subheader">AI Travel Assistant</h2>', unsafe_allow_html=True)
@@ -673,34 +854,157 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
-def ask_gemini(question):
+ASSISTANT_INSTRUCTION = (
+    "You are WanderAI's travel assistant. Answer questions about the traveller's destination and trip "
+    "concisely and practically. When a trip summary is given, use it to tailor your answer."
+)
+
+# One configured model handle per process, shared by every session, so each question
+# reuses its client and connection instead of setting them up again
+@st.cache_resource
+def get_assistant_model():
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel(ASSISTANT_MODEL, system_instruction=ASSISTANT_INSTRUCTION)
+
+def clip(text, limit):
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+# A few lines describing the trip and its itinerary, within ASSISTANT_CONTEXT_TOKENS
+@st.cache_data(max_entries=64, show_spinner=False)
+def itinerary_context(itinerary, destination, num_days, travel_style, transport):
+    lines = [f"Trip: {num_days} days in {destination}, {travel_style.lower()} budget, getting around by {transport.lower()}."]
+    days = itinerary.items() if isinstance(itinerary, dict) else ((None, day) for day in itinerary or [])
+    for label, day in days:
+        if not isinstance(day, dict):
+            lines.append(str(label if label is not None else day))
+            continue
+        activities = "; ".join(f"{a.get('time', '')}: {clip(str(a.get('activity', '')), 80)}"
+                               for a in day.get("activities") or [] if isinstance(a, dict))
+        lines.append(f"{label if label is not None else day.get('day', '')}: {activities}")
+    return clip("\n".join(lines), ASSISTANT_CONTEXT_TOKENS * CHARS_PER_TOKEN)
+
+# The most recent turns that fit in ASSISTANT_HISTORY_TOKENS, as Gemini contents, plus a
+# one-line note listing the questions asked in the turns that were left out
+def trim_history(history):
+    budget = ASSISTANT_HISTORY_TOKENS * CHARS_PER_TOKEN
+    kept = []
+    for turn in reversed(history):
+        budget -= len(turn["text"])
+        if budget < 0:
+            break
+        kept.append(turn)
+    kept.reverse()
+    # The conversation sent to the model has to start with a question
+    while kept and kept[0]["role"] != "user":
+        kept.pop(0)
+    dropped = [turn["text"] for turn in history[:len(history) - len(kept)] if turn["role"] == "user"]
+    note = ""
+    if dropped:
+        note = clip("Earlier the traveller asked: " + "; ".join(clip(q, 80) for q in dropped),
+                    ASSISTANT_SUMMARY_TOKENS * CHARS_PER_TOKEN)
+    return [{"role": turn["role"], "parts": [turn["text"]]} for turn in kept], note
+
+# Stream the answer to a question as it is generated, for st.write_stream. Token counts
+# and latency are filled into usage as the stream goes.
+def stream_answer(question, history, context, usage):
+    contents, note = trim_history(history)
+    prompt = "\n\n".join(part for part in [context, note, question] if part)
+    contents.append({"role": "user", "parts": [prompt]})
+    started = time.perf_counter()
+    response = GEMINI_BREAKER.call(
+        get_assistant_model().generate_content, contents, stream=True,
+        request_options={"timeout": GEMINI_TIMEOUT},
+    )
+    for chunk in response:
+        metadata = getattr(chunk, "usage_metadata", None)
+        if metadata:
+            usage["prompt_tokens"] = metadata.prompt_token_count
+            usage["output_tokens"] = metadata.candidates_token_count + getattr(metadata, "thoughts_token_count", 0)
+        usage["seconds"] = time.perf_counter() - started
+        if chunk.parts:
+            yield chunk.text
+
+# Report an answer's token usage to the backend, which counts it against this session's
+# allowance; when that is used up the assistant pauses until the allowance resets
+def report_assistant_usage(usage, destination, num_days):
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")  
-        response = model.generate_content(question)
-        return response.text.strip()
-    except Exception as e:
-        return f"⚠️ Error: {str(e)}"
+        response = get_http_session().post(
+            USAGE_URL,
+            json={**usage, "destination": destination, "num_days": num_days},
+            headers=client_headers(), timeout=3,
+        )
+        allowance = response.json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"Could not report assistant usage: {e}")
+        return
+    if allowance.get("remaining_tokens") == 0:
+        st.session_state["assistant_paused_until"] = time.time() + (allowance.get("resets_in") or 60)
 
-# Create two columns for input and button
-col1, col2 = st.columns([3, 1])
-with col1:
-    user_query = st.text_input("Ask me anything about your trip:", placeholder="E.g., What's the best time to visit the Eiffel Tower?")
-with col2:
-    ask_button = st.button("Ask", use_container_width=True)
-
-# Process the query
-if ask_button:
-    if user_query:
-        with st.spinner("Thinking..."):
-            response = ask_gemini(user_query)
-            st.markdown(f"""
-            <div class="card" style="margin-top:20px;">
-                <h4 style="margin-top:0;color:#3a7bd5;font-weight:600;">AI's Response:</h4>
-                <p> {response} </p>
-            </div>""", unsafe_allow_html=True)
-            
-    else:
-        st.warning("⚠️ Please enter a question.")
+# Asking a question reruns only the assistant, not the lookups, map and itinerary above.
+# The conversation is kept per session so follow-up questions have their context.
+@st.fragment
+def travel_assistant(destination, num_days, travel_style, transport):
+    history = st.session_state.setdefault("assistant_history", [])
+    conversation = st.container()
+    with conversation:
+        for turn in history:
+            with st.chat_message("user" if turn["role"] == "user" else "assistant"):
+                st.markdown(turn["text"])
+
+    with st.form("assistant_form", clear_on_submit=True, border=False):
+        # Create two columns for input and button
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            user_query = st.text_input("Ask me anything about your trip:", placeholder="E.g., What's the best time to visit the Eiffel Tower?")
+        with col2:
+            ask_button = st.form_submit_button("Ask", use_container_width=True)
+
+    # Process the query
+    if ask_button:
+        if user_query:
+            context = itinerary_context(st.session_state.get("itinerary"), destination, num_days, travel_style, transport)
+            with conversation:
+                with st.chat_message("user"):
+                    st.markdown(user_query)
+                with st.chat_message("assistant"):
+                    # A close paraphrase of an earlier question asked with the same trip context is
+                    # answered at once. Only the first question of a conversation is looked up or
+                    # stored: a follow-up's answer depends on the turns before it, which the cache
+                    # key doesn't cover, so follow-ups always go to the model.
+                    cacheable = not history
+                    cache_key = f"{destination}|{hashlib.sha256(context.encode('utf-8')).hexdigest()[:16]}"
+                    cached = get_answer_cache().get(cache_key, user_query) if cacheable else None
+                    paused_for = st.session_state.get("assistant_paused_until", 0) - time.time()
+                    if cached:
+                        answer = cached["answer"]
+                        st.markdown(answer)
+                        st.caption(f"Answered from a similar earlier question: “{cached['question']}”")
+                    elif paused_for > 0:
+                        answer = None
+                        st.markdown(f"⚠️ You've used your assistant allowance for now, please try again in "
+                                    f"{paused_for / 60:.0f} min.")
+                    else:
+                        usage = {}
+                        try:
+                            answer = st.write_stream(stream_answer(user_query, history, context, usage))
+                            if answer and cacheable:
+                                get_answer_cache().put(cache_key, user_query, str(answer))
+                        except CircuitOpenError as e:
+                            answer = None
+                            st.markdown(f"⚠️ The assistant is temporarily unavailable, please try again in {e.retry_after:.0f}s.")
+                        except Exception as e:
+                            answer = None
+                            st.markdown(f"⚠️ Error: {str(e)}")
+                        if usage:
+                            report_assistant_usage(usage, destination, num_days)
+            # Failed answers aren't kept, so they aren't sent back to the model as context
+            if answer:
+                history += [{"role": "user", "text": user_query}, {"role": "model", "text": str(answer)}]
+                del history[:-ASSISTANT_MAX_TURNS]
+        else:
+            st.warning("⚠️ Please enter a question.")
+
+travel_assistant(destination, num_days, travel_style, transport)
 
 # Footer
 st.markdown("""
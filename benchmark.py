@@ -0,0 +1,268 @@
+# Benchmarks for the WanderAI backend
+#
+# Usage:
+#   python benchmark.py parse         # micro-benchmark itinerary parsing
+#   python benchmark.py load          # load-test the API against a local Gemini stub
+#   python benchmark.py stub          # only run the Gemini stub (point GEMINI_MODEL_URL at it)
+#
+# The load test never calls the real model: it starts a local stub of the generateContent
+# endpoints with configurable latency, error rate, response size and malformed-JSON rate,
+# then runs server.py in-process against it.
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# The regex-based parser that parse_itinerary_to_json replaced, kept for comparison
+def legacy_parse_itinerary(text):
+    json_match = re.search(r'```json\s*([\s\S]*?)\s*```', text)
+    if json_match:
+        json_text = json_match.group(1)
+    else:
+        json_match = re.search(r'\[\s*{[\s\S]*}\s*\]', text)
+        json_text = json_match.group(0) if json_match else text
+    itinerary = json.loads(json_text.strip())
+    if not isinstance(itinerary, list):
+        raise ValueError("Itinerary is not a list")
+    return itinerary
+
+
+# Build a model-style response with the given number of days
+def sample_response(num_days, fenced=False):
+    days = [
+        {
+            "day": f"Day {i + 1}",
+            "activities": [
+                {"time": slot, "activity": f"Visit the \"{slot}\" sights of district {i}, then lunch [local], {{cafe}}"}
+                for slot in ("Morning", "Afternoon", "Evening")
+            ],
+            "budget": "$120 per day",
+            "transport": "Metro and walking",
+        }
+        for i in range(num_days)
+    ]
+    text = json.dumps(days, indent=2)
+    return f"```json\n{text}\n```" if fenced else text
+
+
+# Inputs ranging from typical responses to ones that make the greedy regex backtrack
+def parse_cases():
+    typical = sample_response(5)
+    large = sample_response(500)
+    return {
+        "typical (5 days)": typical,
+        "fenced (5 days)": sample_response(5, fenced=True),
+        "large (500 days)": large,
+        "truncated (500 days)": large[:-200],
+        "trailing commas (500 days)": re.sub(r'"\n(\s*)}', r'",\n\1}', large),
+        "trailing text (500 days)": large + "\nHope you enjoy the trip! }" * 50,
+        "adversarial (unclosed arrays)": "[{" * 2000 + '"x": 1}' * 200,
+    }
+
+
+def run_parse_benchmark(repeat):
+    from server import parse_itinerary_to_json
+
+    print(f"{'case':32} {'legacy regex':>16} {'scanner':>16}")
+    for name, text in parse_cases().items():
+        results = []
+        for parse in (legacy_parse_itinerary, parse_itinerary_to_json):
+            ok = _quiet(parse, text)
+            seconds = min(timeit.repeat(lambda: _quiet(parse, text), number=1, repeat=repeat))
+            results.append(f"{seconds * 1000:9.3f} ms {'ok ' if ok else 'err'}")
+        print(f"{name:32} {results[0]:>16} {results[1]:>16}")
+
+
+# Run a parser with its debug output suppressed; returns whether it succeeded
+def _quiet(parse, text):
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            parse(text)
+        except Exception:
+            return False
+    return True
+
+
+# Local stand-in for the Gemini generateContent and streamGenerateContent endpoints
+class GeminiStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=1.0, jitter=0.25, error_rate=0.0, malformed_rate=0.0, days=None):
+        super().__init__(("127.0.0.1", port), GeminiStubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.days = days
+        self.calls = 0
+
+    @property
+    def model_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1beta/models/stub"
+
+
+class GeminiStubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        stub = self.server
+        stub.calls += 1
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        prompt = body["contents"][0]["parts"][0]["text"]
+        time.sleep(max(0.0, random.gauss(stub.latency, stub.jitter)))
+
+        if random.random() < stub.error_rate:
+            status = random.choice([429, 500, 503])
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": {"code": status, "message": "stub error"}}).encode())
+            return
+
+        text = self._itinerary_text(prompt)
+        if random.random() < stub.malformed_rate:
+            # Typical model faults: trailing commas, or output cut off mid-day
+            text = re.sub(r'"\n(\s*)}', r'",\n\1}', text) if random.random() < 0.5 else text[:int(len(text) * 0.9)]
+
+        if "streamGenerateContent" in self.path:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for start in range(0, len(text), 200):
+                chunk = {"candidates": [{"content": {"parts": [{"text": text[start:start + 200]}]}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode())
+                self.wfile.flush()
+            return
+
+        payload = json.dumps({"candidates": [{"content": {"parts": [{"text": text}]}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _itinerary_text(self, prompt):
+        match = re.search(r"detailed (\d+)-day", prompt)
+        num_days = self.server.days or (int(match.group(1)) if match else 3)
+        return f"```json\n{sample_response(num_days)}\n```"
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# Drive the API at increasing concurrency and report throughput and latency per endpoint
+def run_load_benchmark(args):
+    stub = GeminiStub(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      malformed_rate=args.malformed_rate, days=args.days)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    # Configure server.py before importing it: stub upstream, throwaway store, no warm cache
+    workdir = tempfile.mkdtemp(prefix="wanderai-bench-")
+    os.environ["GEMINI_MODEL_URL"] = stub.model_url
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    os.environ["ITINERARY_DB"] = os.path.join(workdir, "itineraries.db")
+    os.environ["ITINERARY_CACHE_FILE"] = ""
+    import requests
+    from werkzeug.serving import make_server
+    import server
+
+    api = make_server("127.0.0.1", 0, server.app, threaded=True)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{api.server_port}/api/itinerary"
+    session = requests.Session()
+    counter = iter(range(10 ** 9))
+    counter_lock = threading.Lock()
+
+    def one_request():
+        if random.random() < args.read_ratio:
+            endpoint = "GET /api/itinerary"
+            call = lambda: session.get(base_url, timeout=30)
+        else:
+            endpoint = "POST /api/itinerary/generate"
+            if random.random() < args.repeat_ratio:
+                destination = "Paris"  # repeated trips exercise the cache and coalescing
+            else:
+                with counter_lock:
+                    destination = f"Benchmark City {next(counter)}"
+            trip = {"destination": destination, "num_days": args.trip_days, "budget": 330,
+                    "transport": "Public Transport"}
+            call = lambda: session.post(f"{base_url}/generate", json=trip, timeout=120)
+        started = time.perf_counter()
+        try:
+            ok = call().status_code == 200
+        except requests.RequestException:
+            ok = False
+        return endpoint, time.perf_counter() - started, ok
+
+    print(f"stub latency {args.latency}s ±{args.jitter}, error rate {args.error_rate:.0%}, "
+          f"malformed rate {args.malformed_rate:.0%}, {args.trip_days}-day trips")
+    print(f"{'conc':>4} {'endpoint':30} {'reqs':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for concurrency in args.concurrency:
+        results = []
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for result in pool.map(lambda _: one_request(), range(args.requests)):
+                results.append(result)
+        elapsed = time.perf_counter() - started
+
+        for endpoint in sorted({endpoint for endpoint, _, _ in results}):
+            latencies = [latency for name, latency, _ in results if name == endpoint]
+            errors = sum(1 for name, _, ok in results if name == endpoint and not ok)
+            print(f"{concurrency:>4} {endpoint:30} {len(latencies):>6} {len(latencies) / elapsed:>8.1f} "
+                  f"{percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.95) * 1000:>9.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>9.1f} {errors / len(latencies):>7.1%}")
+    print(f"upstream calls made: {stub.calls}")
+    api.shutdown()
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="WanderAI backend benchmarks")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    parse_command = subcommands.add_parser("parse", help="micro-benchmark itinerary parsing")
+    parse_command.add_argument("--repeat", type=int, default=5)
+
+    def add_stub_arguments(command):
+        command.add_argument("--latency", type=float, default=1.0, help="mean stub response time in seconds")
+        command.add_argument("--jitter", type=float, default=0.25, help="standard deviation of stub latency")
+        command.add_argument("--error-rate", type=float, default=0.0, help="fraction of 429/5xx responses")
+        command.add_argument("--malformed-rate", type=float, default=0.0, help="fraction of malformed JSON responses")
+        command.add_argument("--days", type=int, default=None, help="days per response (default: as requested)")
+
+    load_command = subcommands.add_parser("load", help="load-test the API against a local Gemini stub")
+    add_stub_arguments(load_command)
+    load_command.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    load_command.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    load_command.add_argument("--trip-days", type=int, default=3)
+    load_command.add_argument("--read-ratio", type=float, default=0.2, help="fraction of GET /api/itinerary")
+    load_command.add_argument("--repeat-ratio", type=float, default=0.0, help="fraction of repeated trips")
+
+    stub_command = subcommands.add_parser("stub", help="run the Gemini stub on its own")
+    add_stub_arguments(stub_command)
+    stub_command.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.command == "parse":
+        run_parse_benchmark(args.repeat)
+    elif args.command == "load":
+        run_load_benchmark(args)
+    elif args.command == "stub":
+        stub = GeminiStub(port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                          malformed_rate=args.malformed_rate, days=args.days)
+        print(f"Gemini stub listening; set GEMINI_MODEL_URL={stub.model_url}")
+        stub.serve_forever()
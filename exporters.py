@@ -0,0 +1,194 @@
+# Itinerary export formats.
+#
+# Renderers are pure functions of their arguments, so the same itinerary and options
+# always give the same bytes and callers can cache output by a hash of the inputs.
+# render_export_batch only takes and returns plain data so it can run in worker processes.
+import json
+import re
+import unicodedata
+from datetime import datetime, timedelta, timezone
+
+from fpdf import FPDF
+
+EXPORT_FORMATS = ("pdf", "json", "ics")
+
+# Clock times used for activities in calendar exports; other slots become all-day events
+SLOT_HOURS = {"morning": (9, 12), "afternoon": (13, 17), "evening": (18, 21), "night": (20, 23)}
+
+
+# str.translate table that maps text onto what FPDF's core fonts can draw. Characters are
+# resolved on first use and remembered, so each one is looked at once per process.
+class PdfTextTable(dict):
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        if codepoint < 128:
+            value = char
+        else:
+            # Accented letters keep their base letter ("é" -> "e"); anything else becomes "-"
+            value = unicodedata.normalize("NFKD", char).encode("ascii", "ignore").decode() or "-"
+        self[codepoint] = value
+        return value
+
+
+PDF_TEXT = PdfTextTable({
+    ord("•"): "-",
+    ord("‘"): "'",
+    ord("’"): "'",
+    ord("“"): '"',
+    ord("”"): '"',
+    ord("–"): "-",
+    ord("—"): "-",
+    ord("…"): "...",
+})
+
+
+def sanitize(text):
+    return str(text).translate(PDF_TEXT)
+
+
+# Render an itinerary (a list of day dicts, or a dict of days keyed by label) as PDF bytes
+def render_pdf(itinerary, destination, num_days=None, travel_style=None, generated_on=None):
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    pdf.set_font("Arial", "B", 16)
+    pdf.cell(200, 10, sanitize(f"Travel Itinerary: {destination}"), ln=True, align="C")
+    details = [f"{num_days} days" if num_days else None, f"{travel_style} style" if travel_style else None]
+    details = ", ".join(d for d in details if d)
+    if details:
+        pdf.cell(200, 10, sanitize(f"({details})"), ln=True, align="C")
+
+    if generated_on:
+        pdf.set_font("Arial", "", 10)
+        pdf.cell(200, 10, sanitize(f"Generated on: {generated_on}"), ln=True, align="C")
+
+    if isinstance(itinerary, dict):
+        days = [(label, info) for label, info in itinerary.items()]
+    else:
+        days = [(day.get("day", "") if isinstance(day, dict) else day, day) for day in itinerary]
+
+    for label, day in days:
+        pdf.ln(10)
+        pdf.set_font("Arial", "B", 14)
+        pdf.cell(200, 10, sanitize(label), ln=True, align="L")
+        if not isinstance(day, dict):
+            continue
+
+        pdf.set_font("Arial", "B", 12)
+        pdf.cell(200, 10, f"Budget: {sanitize(day.get('budget', 'N/A'))}", ln=True, align="L")
+        pdf.cell(200, 10, f"Transport: {sanitize(day.get('transport', 'N/A'))}", ln=True, align="L")
+
+        pdf.set_font("Arial", "", 12)
+        pdf.ln(5)
+        for activity in day.get("activities") or []:
+            if not isinstance(activity, dict):
+                continue
+            # multi_cell wraps long lines to the page width
+            pdf.multi_cell(0, 10, f"- {sanitize(activity.get('time', ''))}: {sanitize(activity.get('activity', ''))}")
+            pdf.ln(2)
+
+    data = pdf.output(dest="S")
+    # FPDF 1.x returns a latin-1 str, 2.x returns bytes
+    return data.encode("latin-1") if isinstance(data, str) else bytes(data)
+
+
+def render_json(itinerary):
+    return json.dumps(itinerary, indent=4).encode("utf-8")
+
+
+def _ics_escape(text):
+    return str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+# Content lines are folded at 75 octets, continuing with a leading space
+def _ics_fold(line):
+    folded, current, size = [], [], 0
+    for char in line:
+        width = len(char.encode("utf-8"))
+        if size + width > 75:
+            folded.append("".join(current))
+            current, size = [" "], 1
+        current.append(char)
+        size += width
+    folded.append("".join(current))
+    return "\r\n".join(folded)
+
+
+# Calendar with one event per activity, the first day falling on start_date
+def render_ics(itinerary, destination, start_date, uid, stamp):
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//WanderAI//Itinerary//EN", "CALSCALE:GREGORIAN"]
+    days = itinerary.values() if isinstance(itinerary, dict) else itinerary
+    for day_index, day in enumerate(days):
+        if not isinstance(day, dict):
+            continue
+        date = start_date + timedelta(days=day_index)
+        for activity_index, activity in enumerate(day.get("activities") or []):
+            if not isinstance(activity, dict):
+                continue
+            slot = str(activity.get("time", "")).lower()
+            hours = next((h for name, h in SLOT_HOURS.items() if name in slot), None)
+            if hours:
+                start = f"DTSTART:{date:%Y%m%d}T{hours[0]:02d}0000"
+                end = f"DTEND:{date:%Y%m%d}T{hours[1]:02d}0000"
+            else:
+                start = f"DTSTART;VALUE=DATE:{date:%Y%m%d}"
+                end = f"DTEND;VALUE=DATE:{date + timedelta(days=1):%Y%m%d}"
+            details = f"{day.get('day', '')} {activity.get('time', '')}. Budget: {day.get('budget', 'N/A')}. " \
+                      f"Transport: {day.get('transport', 'N/A')}"
+            lines += [
+                "BEGIN:VEVENT",
+                f"UID:{uid}-{day_index + 1}-{activity_index + 1}@wanderai",
+                f"DTSTAMP:{stamp:%Y%m%dT%H%M%SZ}",
+                start,
+                end,
+                f"SUMMARY:{_ics_escape(activity.get('activity', ''))}",
+                f"DESCRIPTION:{_ics_escape(details)}",
+                f"LOCATION:{_ics_escape(destination)}",
+                "END:VEVENT",
+            ]
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(_ics_fold(line) for line in lines) + "\r\n").encode("utf-8")
+
+
+# Render options for a saved itinerary record; the date comes from the record so output is deterministic
+def export_options(record, travel_style=None):
+    return {
+        "destination": record.get("destination") or "your trip",
+        "num_days": record.get("num_days") or len(record["itinerary"]),
+        "travel_style": travel_style or None,
+        "generated_on": datetime.fromtimestamp(record["updated_at"], timezone.utc).strftime("%B %d, %Y"),
+    }
+
+
+def export_filename(destination, suffix):
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", destination).strip("_") or "trip"
+    return f"{slug}_itinerary{suffix}"
+
+
+# One saved itinerary record in one format
+def render_record(record, fmt, travel_style=None):
+    if fmt == "pdf":
+        return render_pdf(record["itinerary"], **export_options(record, travel_style))
+    if fmt == "json":
+        return render_json(record["itinerary"])
+    if fmt == "ics":
+        return render_ics(
+            record["itinerary"], record.get("destination") or "Trip",
+            datetime.fromtimestamp(record["created_at"], timezone.utc).date(), record["id"],
+            datetime.fromtimestamp(record["updated_at"], timezone.utc),
+        )
+    raise ValueError(f"Unknown export format: {fmt}")
+
+
+# Render a batch of records in every requested format. Returns ([(archive path, bytes)],
+# [(record id, error)]); a record that fails in one format is skipped, not the batch.
+def render_export_batch(records, formats, travel_style=None):
+    files, failures = [], []
+    for record in records:
+        for fmt in formats:
+            name = f"{fmt}/{export_filename(record.get('destination') or 'trip', '')}_{record['id'][:8]}.{fmt}"
+            try:
+                files.append((name, render_record(record, fmt, travel_style)))
+            except Exception as e:
+                failures.append((record["id"], f"{fmt}: {e}"))
+    return files, failures
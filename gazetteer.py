@@ -0,0 +1,191 @@
+# Offline place-name index for destination lookups.
+#
+# Cities are loaded from a GeoNames-style TSV into parallel arrays (coordinates and
+# population as packed doubles/ints, names as one list) with a dict from normalized
+# name to row numbers, so a lookup is a string normalization plus a hash probe.
+# Names that miss can be completed by prefix or matched fuzzily, and coordinates
+# found elsewhere (e.g. Nominatim) are written back so the next lookup stays local.
+import bisect
+import difflib
+import os
+import threading
+import unicodedata
+from array import array
+
+GAZETTEER_FILE = os.getenv("GAZETTEER_FILE", os.path.join(os.path.dirname(__file__), "data", "cities.tsv"))
+# Places learned from online geocoding are appended here and reloaded on start
+GAZETTEER_EXTRA_FILE = os.getenv("GAZETTEER_EXTRA_FILE", "gazetteer_extra.tsv")
+FUZZY_CUTOFF = 0.85  # minimum difflib ratio for a fuzzy match
+
+# Names a qualifier may use for a country ("Paris, France"), besides its ISO code
+COUNTRY_NAMES = {
+    "AE": ["united arab emirates", "uae"], "AR": ["argentina"], "AT": ["austria"], "AU": ["australia"],
+    "BE": ["belgium"], "BR": ["brazil"], "CA": ["canada"], "CH": ["switzerland"], "CL": ["chile"],
+    "CN": ["china"], "CO": ["colombia"], "CU": ["cuba"], "CZ": ["czech republic", "czechia"],
+    "DE": ["germany", "deutschland"], "DK": ["denmark"], "EC": ["ecuador"], "EG": ["egypt"],
+    "ES": ["spain", "espana"], "FI": ["finland"], "FR": ["france"],
+    "GB": ["united kingdom", "uk", "great britain", "britain", "england", "scotland", "wales"],
+    "GR": ["greece"], "HK": ["hong kong"], "HR": ["croatia"], "HU": ["hungary"], "ID": ["indonesia"],
+    "IE": ["ireland"], "IL": ["israel"], "IN": ["india"], "IS": ["iceland"], "IT": ["italy", "italia"],
+    "JO": ["jordan"], "JP": ["japan"], "KE": ["kenya"], "KR": ["south korea", "korea"], "LK": ["sri lanka"],
+    "MA": ["morocco"], "MV": ["maldives"], "MX": ["mexico"], "MY": ["malaysia"], "NL": ["netherlands", "holland"],
+    "NO": ["norway"], "NP": ["nepal"], "NZ": ["new zealand"], "PE": ["peru"], "PH": ["philippines"],
+    "PL": ["poland"], "PT": ["portugal"], "QA": ["qatar"], "RU": ["russia"], "SE": ["sweden"],
+    "SG": ["singapore"], "TH": ["thailand"], "TR": ["turkey", "turkiye"], "TW": ["taiwan"], "TZ": ["tanzania"],
+    "US": ["united states", "united states of america", "usa", "america"], "VN": ["vietnam", "viet nam"],
+    "ZA": ["south africa"],
+}
+
+
+# Lower-case, strip accents and punctuation and collapse whitespace: "  São-Paulo " -> "sao paulo"
+def normalize_name(name):
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    cleaned = "".join(c if c.isalnum() else " " for c in stripped.lower())
+    return " ".join(cleaned.split())
+
+
+class Gazetteer:
+    def __init__(self):
+        self.names = []
+        self.countries = []
+        self.admins = []  # first-level admin code (e.g. "TX"), when the source has one
+        self.latitudes = array("d")
+        self.longitudes = array("d")
+        self.populations = array("q")
+        # Normalized name -> row numbers, most populous first
+        self._index = {}
+        self._sorted_keys = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    # Load rows from either our 7-column layout or a full 19-column GeoNames dump; missing files are skipped
+    def load(self, path):
+        if not path or not os.path.exists(path):
+            return self
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                try:
+                    admin = ""
+                    if len(fields) >= 19:
+                        name, ascii_name, alternates = fields[1], fields[2], fields[3]
+                        lat, lon, country, admin, population = fields[4], fields[5], fields[8], fields[10], fields[14]
+                    else:
+                        name, ascii_name, alternates, lat, lon, country, population = fields[:7]
+                    self._add_row(name, [ascii_name] + alternates.split(","), float(lat), float(lon),
+                                  country, int(population or 0), admin)
+                except (ValueError, IndexError):
+                    print(f"Skipping malformed gazetteer row in {path}: {line.strip()[:80]}")
+        return self
+
+    def _add_row(self, name, aliases, lat, lon, country="", population=0, admin=""):
+        with self._lock:
+            row = len(self.names)
+            self.names.append(name)
+            self.countries.append(country)
+            self.admins.append(admin)
+            self.latitudes.append(lat)
+            self.longitudes.append(lon)
+            self.populations.append(population)
+            for key in {normalize_name(alias) for alias in [name] + aliases if alias}:
+                rows = self._index.setdefault(key, [])
+                rows.append(row)
+                rows.sort(key=lambda r: -self.populations[r])
+            self._sorted_keys = None
+        return row
+
+    def _keys(self):
+        keys = self._sorted_keys
+        if keys is None:
+            with self._lock:
+                keys = self._sorted_keys = sorted(self._index)
+        return keys
+
+    def _place(self, row):
+        return {
+            "name": self.names[row],
+            "country": self.countries[row],
+            "lat": self.latitudes[row],
+            "lon": self.longitudes[row],
+        }
+
+    # Whether every qualifier after the city ("Texas", "France") names the row's country, its
+    # admin area or the row itself
+    def _matches_qualifiers(self, row, qualifiers):
+        country = self.countries[row]
+        known = {normalize_name(country), normalize_name(self.admins[row]), *COUNTRY_NAMES.get(country, [])}
+        return all(key in known or row in self._index.get(key, []) for key in qualifiers)
+
+    # Most populous row for a normalized name that agrees with the qualifiers, or None
+    def _best_row(self, key, qualifiers):
+        for row in self._index.get(key, []):
+            if self._matches_qualifiers(row, qualifiers):
+                return row
+        return None
+
+    # Exact match on the normalized name. "Paris, France" falls back to a "paris" that is in
+    # France; "Paris, Texas" finds nothing here, so it can be looked up online instead.
+    def get(self, query):
+        rows = self._index.get(normalize_name(query))
+        if rows:
+            return self._place(rows[0])
+        if "," not in query:
+            return None
+        city, *qualifiers = query.split(",")
+        row = self._best_row(normalize_name(city), [normalize_name(q) for q in qualifiers if normalize_name(q)])
+        return self._place(row) if row is not None else None
+
+    # Exact match, then the closest spelling among names with the same first letter
+    def lookup(self, query):
+        place = self.get(query)
+        if place is not None:
+            return place
+        city, *qualifiers = query.split(",")
+        key = normalize_name(city)
+        if not key:
+            return None
+        keys = self._keys()
+        start = bisect.bisect_left(keys, key[0])
+        end = bisect.bisect_left(keys, chr(ord(key[0]) + 1))
+        matches = difflib.get_close_matches(key, keys[start:end], n=1, cutoff=FUZZY_CUTOFF)
+        if not matches:
+            return None
+        row = self._best_row(matches[0], [normalize_name(q) for q in qualifiers if normalize_name(q)])
+        return self._place(row) if row is not None else None
+
+    # Places whose normalized name starts with the prefix, most populous first
+    def complete(self, prefix, limit=10):
+        key = normalize_name(prefix)
+        if not key:
+            return []
+        keys = self._keys()
+        rows = set()
+        for i in range(bisect.bisect_left(keys, key), len(keys)):
+            if not keys[i].startswith(key):
+                break
+            rows.update(self._index[keys[i]])
+        ranked = sorted(rows, key=lambda r: -self.populations[r])[:limit]
+        return [self._place(row) for row in ranked]
+
+    # Remember a place found elsewhere; it is appended to path so it survives restarts
+    def add(self, name, lat, lon, country="", path=None):
+        name = " ".join(name.split())
+        if not normalize_name(name) or self.get(name) is not None:
+            return
+        self._add_row(name, [], lat, lon, country)
+        if path:
+            try:
+                with self._lock, open(path, "a", encoding="utf-8") as f:
+                    f.write(f"{name}\t{name}\t\t{lat}\t{lon}\t{country}\t0\n")
+            except OSError as e:
+                print(f"Could not persist gazetteer entry for {name}: {e}")
+
+
+# Bundled cities plus anything learned from online geocoding
+def load_gazetteer(path=GAZETTEER_FILE, extra_path=GAZETTEER_EXTRA_FILE):
+    return Gazetteer().load(path).load(extra_path)
@@ -0,0 +1,293 @@
+# Geocoding for the places named in itinerary activities.
+#
+# Place names are pulled out of each activity's text and looked up in a persistent SQLite
+# cache in one query per batch. Only the misses go to Nominatim, through a single worker
+# thread that spaces requests according to its usage policy (at most one per second).
+# Single lookups such as the destination go ahead of queued activity places.
+# The same place requested from several reruns or sessions shares one queued request,
+# and results are cached whether or not the caller is still waiting for them.
+import os
+import queue
+import re
+import sqlite3
+import itertools
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError, wait
+
+import requests
+
+from gazetteer import normalize_name
+from resilience import BREAKERS
+
+GEOCODE_DB = os.getenv("GEOCODE_DB", "geocodes.db")
+GEOCODE_TTL = 30 * 24 * 60 * 60
+GEOCODE_MISS_TTL = 24 * 60 * 60  # places Nominatim couldn't find are retried after a day
+GEOCODE_QUEUE_LIMIT = 500  # queued lookups beyond this are dropped and retried on a later call
+# Queue priorities: a single lookup (the destination, which centers the map) goes ahead of activity places
+PRIORITY_SINGLE = 0
+PRIORITY_BATCH = 1
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+NOMINATIM_USER_AGENT = "AI-Travel-Planner/1.0 (garimaabhayanaa@gmail.com)"
+NOMINATIM_MIN_INTERVAL = float(os.getenv("NOMINATIM_MIN_INTERVAL", "1.0"))  # seconds between requests
+NOMINATIM_TIMEOUT = 8
+NOMINATIM_BACKOFF = 30  # pause after a 429 when no Retry-After is given
+SEARCH_RADIUS = 0.5  # degrees around the destination that activity places must fall within
+
+MAX_PLACES_PER_ACTIVITY = 3
+
+# Regex character class of every upper-case letter in the Basic Multilingual Plane, as ranges
+def _upper_class():
+    ranges = []
+    for code in range(0x10000):
+        if chr(code).isupper():
+            if ranges and ranges[-1][1] == code - 1:
+                ranges[-1][1] = code
+            else:
+                ranges.append([code, code])
+    return "[" + "".join(re.escape(chr(a)) if a == b else f"{re.escape(chr(a))}-{re.escape(chr(b))}"
+                         for a, b in ranges) + "]"
+
+
+# Capitalized words, in any alphabet, joined by lower-case connectors: "Musée d'Orsay", "Café de
+# Flore", "Tower of London", "Île de la Cité". A word may follow an elided d' or l' ("d'Orsay").
+# A period ends a word, so names never run across sentences, except in a few abbreviations ("St. Paul's").
+_UPPER = _upper_class()
+_WORD = rf"(?:\b[dl]['’])?(?:(?:St|Ste|Mt|Ft)\.|{_UPPER}[\w'’-]*)"
+_CONNECTOR = r"(?:of|de|du|des|la|le|les|del|della|di|da|do|dos|the|von|van|der|am|an|on|au|aux|sur)"
+PLACE_PATTERN = re.compile(rf"{_WORD}(?:\s+(?:{_CONNECTOR}\s+)*{_WORD})*")
+
+# Capitalized words that start sentences or name meals and times of day rather than places
+NON_PLACE_WORDS = {
+    "a", "an", "the", "and", "of", "in", "at", "on", "to", "for", "from", "with", "via", "near", "then",
+    "visit", "explore", "enjoy", "head", "take", "start", "begin", "walk", "stroll", "wander", "have", "see",
+    "discover", "check", "admire", "tour", "spend", "go", "climb", "hike", "sample", "try", "taste", "shop",
+    "catch", "watch", "experience", "end", "finish", "continue", "return", "relax", "grab", "savor", "savour",
+    "indulge", "dine", "board", "cruise", "ride", "book", "join", "learn", "browse", "marvel", "attend",
+    "breakfast", "brunch", "lunch", "dinner", "morning", "afternoon", "evening", "night", "day", "optional",
+    "free", "local", "traditional", "famous", "historic", "after", "afterwards", "before", "later", "next",
+    "if", "or", "option", "alternatively", "budget", "transport", "note", "tip", "i", "you", "your",
+    "metro", "subway", "bus", "train", "tram", "taxi", "uber", "ferry", "car", "bike",
+}
+# Single words with these endings are usually demonyms ("Parisian dinner", "Japanese garden")
+DEMONYM_SUFFIXES = ("ian", "ese", "ish")
+
+
+# Place names mentioned in an activity, most specific first; skips the destination itself
+def extract_activity_places(text, destination=""):
+    destination_key = normalize_name(destination.split(",")[0])
+    places = []
+    for match in PLACE_PATTERN.finditer(text):
+        words = match.group(0).rstrip(".").split()
+        while words and words[0].lower() in NON_PLACE_WORDS:
+            words.pop(0)
+        while words and words[-1].lower() in NON_PLACE_WORDS:
+            words.pop()
+        if not words or (len(words) == 1 and (len(words[0]) < 5 or words[0].lower().endswith(DEMONYM_SUFFIXES))):
+            continue
+        place = " ".join(words)
+        key = normalize_name(place)
+        if key and key != destination_key and key not in (normalize_name(p) for p in places):
+            places.append(place)
+        if len(places) >= MAX_PLACES_PER_ACTIVITY:
+            break
+    return places
+
+
+# One stop per place named in the itinerary: {"day", "day_label", "activity_index", "time", "activity", "place"}
+def extract_places(itinerary, destination=""):
+    stops = []
+    for index, day in enumerate(itinerary):
+        if not isinstance(day, dict):
+            continue
+        for activity_index, activity in enumerate(day.get("activities") or []):
+            if not isinstance(activity, dict):
+                continue
+            text = str(activity.get("activity", ""))
+            for place in extract_activity_places(text, destination):
+                stops.append({
+                    "day": index + 1,
+                    "day_label": day.get("day", f"Day {index + 1}"),
+                    "activity_index": activity_index,
+                    "time": activity.get("time", ""),
+                    "activity": text,
+                    "place": place,
+                })
+    return stops
+
+
+# Cache key: the normalized place plus the rounded search centre, so "Old Town" in
+# two different cities are separate entries
+def geocode_key(place, near=None):
+    key = normalize_name(place)
+    if near is not None:
+        key += f"@{near[0]:.1f},{near[1]:.1f}"
+    return key
+
+
+class GeocodeCache:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS geocodes (
+                    key TEXT PRIMARY KEY,
+                    lat REAL,
+                    lon REAL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+
+    # Fresh entries for the given keys in one query: {key: (lat, lon) or None for a known miss}
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        conn = self._connect()
+        for start in range(0, len(keys), 500):  # stay under SQLite's bound-parameter limit
+            batch = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT key, lat, lon, updated_at FROM geocodes WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            ).fetchall()
+            for key, lat, lon, updated_at in rows:
+                if lat is None:
+                    if now - updated_at < GEOCODE_MISS_TTL:
+                        found[key] = None
+                elif now - updated_at < GEOCODE_TTL:
+                    found[key] = (lat, lon)
+        return found
+
+    def put(self, key, location):
+        lat, lon = location if location is not None else (None, None)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO geocodes (key, lat, lon, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET lat = excluded.lat, lon = excluded.lon, "
+                "updated_at = excluded.updated_at",
+                (key, lat, lon, time.time()),
+            )
+
+    # One connection per thread; WAL lets the app read while the geocoder writes
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+
+class RateLimitedGeocoder:
+    def __init__(self, cache, min_interval=NOMINATIM_MIN_INTERVAL):
+        self.cache = cache
+        self.min_interval = min_interval
+        self._session = requests.Session()
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()  # keeps lookups of equal priority first in, first out
+        self._pending = {}  # key -> (future, priority it is queued at)
+        self._lock = threading.Lock()
+        self._next_request = 0.0
+        # While Nominatim keeps failing, queued lookups fail at once instead of waiting their turn
+        self.breaker = BREAKERS.get("nominatim", timeout=NOMINATIM_TIMEOUT)
+        threading.Thread(target=self._run, name="nominatim-geocoder", daemon=True).start()
+
+    # Geocode many places near a point. Cache hits return at once; misses are queued and
+    # waited on for up to timeout seconds. Returns ({place: (lat, lon)}, places still pending)
+    def geocode_many(self, places, near=None, timeout=None):
+        keys = {place: geocode_key(place, near) for place in places}
+        cached = self.cache.get_many(set(keys.values()))
+        futures = {}
+        for place, key in keys.items():
+            if key not in cached:
+                future = self._submit(key, place, near, PRIORITY_BATCH)
+                if future is not None:
+                    futures[place] = future
+        if futures and timeout:
+            wait(futures.values(), timeout=timeout)
+
+        locations = {place: cached[key] for place, key in keys.items() if cached.get(key)}
+        pending = 0
+        for place, future in futures.items():
+            if not future.done():
+                pending += 1
+            elif future.exception() is None and future.result() is not None:
+                locations[place] = future.result()
+        return locations, pending
+
+    # Geocode a single place ahead of any queued batch lookups, raising TimeoutError if it
+    # isn't looked up in time
+    def geocode(self, place, near=None, timeout=None):
+        key = geocode_key(place, near)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            return cached[key]
+        future = self._submit(key, place, near, PRIORITY_SINGLE)
+        if future is None:
+            raise TimeoutError("geocoding queue is full")
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"timed out waiting to geocode {place}")
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    # Queue a lookup unless the same key is already queued, in which case it shares that
+    # lookup and moves it up to this priority. Batch lookups get None when the queue is full.
+    def _submit(self, key, place, near, priority):
+        with self._lock:
+            future, queued_priority = self._pending.get(key, (None, None))
+            if future is not None:
+                if priority >= queued_priority:
+                    return future
+            elif priority == PRIORITY_BATCH and len(self._pending) >= GEOCODE_QUEUE_LIMIT:
+                return None
+            else:
+                future = Future()
+            self._pending[key] = (future, priority)
+        self._queue.put((priority, next(self._order), key, place, near, future))
+        return future
+
+    def _run(self):
+        while True:
+            _, _, key, place, near, future = self._queue.get()
+            if future.done():
+                continue  # moved up and already looked up from its higher-priority entry
+            try:
+                location = self.breaker.call(self._search, place, near)
+                self.cache.put(key, location)
+                future.set_result(location)
+            except Exception as e:
+                # Failures aren't cached; the place is retried the next time it is requested
+                print(f"Geocoding failed for {place}: {e}")
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+
+    # One Nominatim request, spaced at least min_interval after the previous one
+    def _search(self, place, near):
+        delay = self._next_request - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_request = time.monotonic() + self.min_interval
+        params = {"q": place, "format": "json", "limit": 1}
+        if near is not None:
+            lat, lon = near
+            params["viewbox"] = f"{lon - SEARCH_RADIUS},{lat + SEARCH_RADIUS},{lon + SEARCH_RADIUS},{lat - SEARCH_RADIUS}"
+            params["bounded"] = 1
+        response = self._session.get(
+            NOMINATIM_URL, params=params, headers={"User-Agent": NOMINATIM_USER_AGENT}, timeout=self.breaker.timeout
+        )
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "")
+            pause = float(retry_after) if retry_after.isdigit() else NOMINATIM_BACKOFF
+            self._next_request = time.monotonic() + pause
+        response.raise_for_status()
+        results = response.json()
+        if not results:
+            return None
+        return float(results[0]["lat"]), float(results[0]["lon"])
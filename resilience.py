@@ -0,0 +1,140 @@
+# Circuit breakers for calls to external services (Gemini, OpenWeather, Unsplash, Nominatim).
+#
+# Each dependency gets one breaker per process, holding its timeout budget. After
+# failure_threshold consecutive failures the breaker opens and calls fail immediately
+# (or return the caller's fallback) instead of waiting on a service that is down. Once
+# reset_timeout has passed a single probe call is let through: success closes the
+# breaker, failure opens it for another reset_timeout.
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}  # numeric form for metrics
+
+
+# Raised instead of calling a dependency whose breaker is open
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+# Client errors mean the request was wrong, not that the service is unhealthy, so they don't
+# count towards opening the breaker; 429, 5xx, timeouts and connection errors do
+def is_dependency_failure(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is None or status == 429 or status >= 500
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, timeout=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout  # seconds callers should allow each request to this dependency
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    # Whether a call may go ahead now; in half-open state only one probe is allowed at a time
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == CLOSED or (self.state == HALF_OPEN and not self._probing):
+                self._probing = self.state == HALF_OPEN
+                self.calls += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    print(f"Circuit for {self.name} opened after {self.consecutive_failures} failures")
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def retry_after(self):
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    # Run fn through the breaker. When the breaker is open, or fn fails, fallback() is
+    # returned if given; otherwise CircuitOpenError or fn's own error is raised.
+    def call(self, fn, *args, fallback=None, **kwargs):
+        if not self.allow():
+            if fallback is not None:
+                return fallback()
+            raise CircuitOpenError(self.name, self.retry_after())
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if is_dependency_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            if fallback is not None:
+                return fallback()
+            raise
+        self.record_success()
+        return result
+
+    def snapshot(self):
+        retry_after = self.retry_after()
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "timeout": self.timeout,
+                "retry_after": round(retry_after, 1),
+                "calls": self.calls,
+                "failures": self.failures,
+                "rejected": self.rejected,
+            }
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    # The breaker for a dependency, created with these settings on first use
+    def get(self, name, **settings):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, **settings)
+            return breaker
+
+    # {dependency: breaker state} for /api/stats and dashboards
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+
+BREAKERS = BreakerRegistry()
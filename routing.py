@@ -0,0 +1,156 @@
+# Route ordering for each day's activities.
+#
+# Once activities are geocoded, each day gets a haversine distance matrix (NumPy, all
+# pairs at once) and its stops are reordered with nearest-neighbour followed by 2-opt,
+# whose candidate moves are also scored as one array operation. The Morning/Afternoon/
+# Evening labels stay where they are and only the activities move between them.
+# Activities tied to a time of day (meals, sunset, nightlife) and ones that couldn't be
+# located stay put; the others are reordered within the runs between them, and a run
+# keeps its original order unless the new one is strictly shorter.
+import re
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+MAX_TWO_OPT_PASSES = 100
+
+# Activities mentioning these keep their slot
+TIME_BOUND_PATTERN = re.compile(
+    r"\b(breakfast|brunch|lunch|dinner|supper|sunrise|sunset|night|nightlife|overnight|check[- ]?in|check[- ]?out)\b",
+    re.IGNORECASE,
+)
+
+
+# Great-circle distances in km between every pair of points
+def haversine_matrix(lats, lons):
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lon = np.radians(np.asarray(lons, dtype=float))
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def route_length(matrix, order):
+    order = np.asarray(order, dtype=int)
+    if len(order) < 2:
+        return 0.0
+    return float(matrix[order[:-1], order[1:]].sum())
+
+
+# Greedy path through nodes starting next to start (a node not in nodes)
+def nearest_neighbour(matrix, start, nodes):
+    remaining = list(nodes)
+    path = []
+    current = start
+    while remaining:
+        nearest = int(np.argmin(matrix[current, remaining]))
+        current = remaining.pop(nearest)
+        path.append(current)
+    return path
+
+
+# Improve a path with fixed first and last nodes by reversing the sub-path that saves the
+# most distance until no reversal helps. All candidate reversals are scored at once.
+def two_opt(matrix, path):
+    path = np.asarray(path, dtype=int)
+    if len(path) < 4:
+        return path
+    inner = np.arange(1, len(path) - 1)
+    upper = inner[:, None] < inner[None, :]
+    for _ in range(MAX_TWO_OPT_PASSES):
+        before, first = path[inner - 1], path[inner]
+        last, after = path[inner], path[inner + 1]
+        # Reversing path[i..j] swaps edges (i-1, i) and (j, j+1) for (i-1, j) and (i, j+1)
+        delta = (matrix[before[:, None], last[None, :]] + matrix[first[:, None], after[None, :]]
+                 - matrix[before, first][:, None] - matrix[last, after][None, :])
+        delta = np.where(upper, delta, 0.0)
+        i, j = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[i, j] > -1e-9:
+            break
+        path[inner[i]:inner[j] + 1] = path[inner[i]:inner[j] + 1][::-1].copy()
+    return path
+
+
+# New order for one day's activities given each one's (lat, lon) or None. Fixed activities
+# and unlocated ones keep their index; the rest are reordered within each run between them.
+def order_day(positions, fixed):
+    located = [i for i, position in enumerate(positions) if position is not None]
+    if len(located) < 3:
+        return list(range(len(positions)))
+
+    # Node k is located[k]; the last node is a dummy zero-distance endpoint standing in
+    # for a missing anchor at either end of a run
+    matrix = np.zeros((len(located) + 1, len(located) + 1))
+    matrix[:-1, :-1] = haversine_matrix([positions[i][0] for i in located], [positions[i][1] for i in located])
+    dummy = len(located)
+
+    order = list(range(len(positions)))
+    run = []
+    anchor = None
+    for node, index in enumerate(located + [None]):
+        if index is not None and not fixed[index]:
+            run.append(node)
+            continue
+        end = dummy if index is None else node
+        if len(run) > 1:
+            start = dummy if anchor is None else anchor
+            path = two_opt(matrix, [start] + nearest_neighbour(matrix, start, run) + [end])
+            # Nearest-neighbour plus 2-opt is a heuristic: keep the run as written unless it wins
+            if route_length(matrix, path) < route_length(matrix, [start] + run + [end]) - 1e-9:
+                for slot, new_node in zip(run, path[1:-1]):
+                    order[located[slot]] = located[new_node]
+        run = []
+        anchor = node if index is not None else None
+    return order
+
+
+# Path length of a day in km, over its located activities in their current order
+def day_distance(positions):
+    points = [p for p in positions if p is not None]
+    if len(points) < 2:
+        return 0.0
+    matrix = haversine_matrix([p[0] for p in points], [p[1] for p in points])
+    return route_length(matrix, range(len(points)))
+
+
+# Position of each activity: the first located place it mentions
+def activity_positions(itinerary, stops):
+    positions = [[None] * len(day.get("activities") or []) if isinstance(day, dict) else [] for day in itinerary]
+    for stop in stops:
+        day, index = stop["day"] - 1, stop["activity_index"]
+        if 0 <= day < len(positions) and index < len(positions[day]) and positions[day][index] is None:
+            positions[day][index] = (stop["lat"], stop["lon"])
+    return positions
+
+
+# Estimated travel distance per day and in total, in km
+def itinerary_distance(itinerary, stops):
+    days = [day_distance(positions) for positions in activity_positions(itinerary, stops)]
+    return {"days": days, "total_km": sum(days)}
+
+
+# Reorder every day's activities to cut travel distance. Returns the new itinerary and a
+# report of estimated distances: {"days": [{"day", "before_km", "after_km"}], "before_km", "after_km"}
+def optimize_itinerary(itinerary, stops):
+    optimized = []
+    report = {"days": [], "before_km": 0.0, "after_km": 0.0}
+    for number, (day, positions) in enumerate(zip(itinerary, activity_positions(itinerary, stops)), start=1):
+        activities = day.get("activities") if isinstance(day, dict) else None
+        if not activities or not all(isinstance(a, dict) for a in activities):
+            optimized.append(day)
+            continue
+        fixed = [bool(TIME_BOUND_PATTERN.search(str(a.get("activity", "")))) for a in activities]
+        order = order_day(positions, fixed)
+        # Slot labels stay in place; the activities move between them
+        reordered = [dict(activities[source], time=activities[slot].get("time")) for slot, source in enumerate(order)]
+        optimized.append(dict(day, activities=reordered))
+
+        before = day_distance(positions)
+        after = day_distance([positions[source] for source in order])
+        report["days"].append({"day": number, "before_km": round(before, 2), "after_km": round(after, 2)})
+        report["before_km"] += before
+        report["after_km"] += after
+    report["before_km"] = round(report["before_km"], 2)
+    report["after_km"] = round(report["after_km"], 2)
+    return optimized, report
@@ -1,10 +1,33 @@
 # Import necessary libraries
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import hashlib
+import hmac
 import json
+import multiprocessing
+import queue
+import random
 import re
 import requests
+import sqlite3
+from requests.adapters import HTTPAdapter
 import os
+import atexit
+import threading
+import time
+import uuid
+import zipfile
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+from exporters import EXPORT_FORMATS, export_filename, export_options, render_export_batch, render_pdf
+from metrics import REGISTRY
+from resilience import BREAKERS, STATE_VALUES, CircuitOpenError
+from usage import (GEMINI_INPUT_PRICE, GEMINI_OUTPUT_PRICE, USAGE_REQUEST_TOKEN_LIMIT, TokenBudgetExceeded,
+                   UsageMeter, UsageTracker, estimate_cost)
 
 # Load environment variables
 load_dotenv()
@@ -12,106 +35,1004 @@ load_dotenv()
 # Initialize Flask app
 app = Flask(__name__)
 
+# Metrics exposed on /metrics
+STAGE_SECONDS = REGISTRY.histogram(
+    "wanderai_stage_seconds", "Time spent in each itinerary generation stage", ["stage"])
+REQUEST_SECONDS = REGISTRY.histogram(
+    "wanderai_http_request_seconds", "Time to handle HTTP requests", ["endpoint", "method", "status"])
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "wanderai_http_requests_in_flight", "HTTP requests currently being handled")
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    "wanderai_gemini_responses_total", "Gemini API responses by HTTP status or connection error", ["status"])
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge(
+    "wanderai_gemini_requests_in_flight", "Gemini API requests waiting for a response")
+PARSE_FAILURES = REGISTRY.counter(
+    "wanderai_parse_failures_total", "Model responses that could not be parsed", ["kind"])
+CACHE_REQUESTS = REGISTRY.counter(
+    "wanderai_itinerary_requests_total", "Itinerary requests by cache outcome", ["result"])
+EXPORTED_FILES = REGISTRY.counter(
+    "wanderai_exported_files_total", "Files written by bulk exports", ["format"])
+GEMINI_TOKENS = REGISTRY.counter(
+    "wanderai_gemini_tokens_total", "Gemini tokens used by kind of call and token type", ["kind", "type"])
+GEMINI_COST = REGISTRY.counter(
+    "wanderai_gemini_cost_usd_total", "Estimated Gemini cost in USD by kind of call", ["kind"])
+
+# Result cache settings
+ITINERARY_CACHE_FILE = os.getenv("ITINERARY_CACHE_FILE", "itinerary_cache.json")
+ITINERARY_CACHE_SIZE = int(os.getenv("ITINERARY_CACHE_SIZE", 256))
+ITINERARY_CACHE_TTL = int(os.getenv("ITINERARY_CACHE_TTL", 6 * 60 * 60))  # seconds
+ITINERARY_CACHE_SAVE_DELAY = float(os.getenv("ITINERARY_CACHE_SAVE_DELAY", 1.0))  # seconds of changes saved together
+
+# Common alternative spellings that should share a cache entry
+DESTINATION_ALIASES = {
+    "nyc": "new york",
+    "new york city": "new york",
+    "new york, ny": "new york",
+    "la": "los angeles",
+    "sf": "san francisco",
+    "paris, france": "paris",
+    "london, uk": "london",
+    "london, england": "london",
+    "rome, italy": "rome",
+    "roma": "rome",
+    "tokyo, japan": "tokyo",
+    "bombay": "mumbai",
+    "new delhi": "delhi",
+    "bangkok, thailand": "bangkok",
+    "barcelona, spain": "barcelona",
+}
+
+# LRU cache with per-entry expiry, optionally persisted to a JSON file. Changes are saved
+# off the request path by one background writer, which waits save_delay seconds so a burst
+# of sets becomes one write, and always writes the entries as they are at that moment.
+class TTLCache:
+    def __init__(self, max_entries, ttl, path=None, save_delay=ITINERARY_CACHE_SAVE_DELAY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()  # set when entries changed since the last save
+        self._save_lock = threading.Lock()
+        self._writer = None
+        self._load()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self.path and self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="cache-writer", daemon=True)
+                self._writer.start()
+        if self.path:
+            self._dirty.set()
+
+    # Save now if anything changed since the last save
+    def flush(self):
+        with self._save_lock:
+            if not self._dirty.is_set():
+                return
+            # Cleared before the snapshot, so a set that lands after it is saved next time
+            self._dirty.clear()
+            with self._lock:
+                snapshot = list(self._entries.items())
+            self._save(snapshot)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    # Restore unexpired entries so a restarted server starts warm
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                stored = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+        now = time.time()
+        for key, expires_at, value in stored[-self.max_entries:] if self.max_entries > 0 else []:
+            if expires_at > now:
+                self._entries[key] = (expires_at, value)
+
+    def _write_loop(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.save_delay)
+            self.flush()
+
+    # Write to a temp file and swap it in so a crash never leaves a torn cache file
+    def _save(self, snapshot):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with STAGE_SECONDS.time(stage="cache_write"):
+                with open(tmp_path, "w", encoding="utf-8") as file:
+                    json.dump([[key, expires_at, value] for key, (expires_at, value) in snapshot], file)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not persist cache to {self.path}: {e}")
+
+itinerary_cache = TTLCache(ITINERARY_CACHE_SIZE, ITINERARY_CACHE_TTL, ITINERARY_CACHE_FILE)
+atexit.register(itinerary_cache.flush)
+
+# Build a cache key that ignores case, extra whitespace and known destination aliases
+def normalize_trip_key(trip):
+    def clean(value):
+        return " ".join(str(value if value is not None else "").lower().split())
+
+    def place(destination):
+        name = clean(destination)
+        return DESTINATION_ALIASES.get(name, name)
+
+    if len(trip["legs"]) > 1:
+        destination = ">".join(f"{place(leg['destination'])}:{leg['num_days']}" for leg in trip["legs"])
+    else:
+        destination = place(trip["destination"])
+    return "|".join([destination, clean(trip["num_days"]), clean(trip["budget"]), clean(trip["transport"])])
+
+# Itinerary store settings
+ITINERARY_DB = os.getenv("ITINERARY_DB", "itineraries.db")
+ITINERARY_PAGE_SIZE = 20
+ITINERARY_MAX_PAGE_SIZE = 100
+
+# Itineraries persisted in SQLite (WAL mode), keyed by id. Writes are queued to a single
+# writer thread so requests never wait on the disk; records not yet written are served
+# from memory until the writer catches up.
+class ItineraryStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    # Create the table and start the writer on first use rather than at import, so processes
+    # that import this module without serving requests (export workers) open nothing
+    def _start(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            with self._connection() as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS itineraries (
+                        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                        id TEXT UNIQUE NOT NULL,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL,
+                        destination TEXT,
+                        num_days INTEGER,
+                        budget TEXT,
+                        transport TEXT,
+                        data TEXT NOT NULL
+                    )
+                """)
+            threading.Thread(target=self._write_loop, name="itinerary-writer", daemon=True).start()
+            self._started = True
+
+    # Queue a new itinerary for writing and return its id immediately
+    def save(self, itinerary, destination=None, num_days=None, budget=None, transport=None):
+        now = time.time()
+        record = {
+            "id": uuid.uuid4().hex,
+            "created_at": now,
+            "updated_at": now,
+            "destination": destination,
+            "num_days": num_days if isinstance(num_days, int) else None,
+            "budget": None if budget is None else str(budget),
+            "transport": transport,
+            "itinerary": itinerary,
+        }
+        self._enqueue(record)
+        return record["id"]
+
+    # Queue a replacement itinerary for an existing record; returns the updated record or None
+    def update(self, itinerary_id, itinerary):
+        record = self.get(itinerary_id)
+        if record is None:
+            return None
+        record = dict(record, itinerary=itinerary, updated_at=time.time())
+        self._enqueue(record)
+        return record
+
+    def get(self, itinerary_id):
+        with self._pending_lock:
+            record = self._pending.get(itinerary_id)
+        if record is not None:
+            return record
+        row = self._connect().execute(
+            "SELECT id, created_at, updated_at, destination, num_days, budget, transport, data "
+            "FROM itineraries WHERE id = ?",
+            (itinerary_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        record = self._summary(row)
+        record["itinerary"] = json.loads(row[7])
+        return record
+
+    # Newest first, keyset-paginated so only one page of summaries is read at a time
+    def list(self, limit=ITINERARY_PAGE_SIZE, cursor=None):
+        query = "SELECT id, created_at, updated_at, destination, num_days, budget, transport, seq FROM itineraries"
+        params = []
+        if cursor is not None:
+            query += " WHERE seq < ?"
+            params.append(cursor)
+        query += " ORDER BY seq DESC LIMIT ?"
+        params.append(limit + 1)
+        rows = self._connect().execute(query, params).fetchall()
+        next_cursor = rows[limit - 1][7] if len(rows) > limit else None
+        return [self._summary(row) for row in rows[:limit]], next_cursor
+
+    # Full records oldest first, read one keyset page at a time so memory stays flat
+    def iter_records(self, batch_size=ITINERARY_PAGE_SIZE):
+        cursor = 0
+        while True:
+            rows = self._connect().execute(
+                "SELECT id, created_at, updated_at, destination, num_days, budget, transport, data, seq "
+                "FROM itineraries WHERE seq > ? ORDER BY seq LIMIT ?",
+                (cursor, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            yield [dict(self._summary(row), itinerary=json.loads(row[7])) for row in rows]
+            cursor = rows[-1][8]
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM itineraries").fetchone()[0]
+
+    # Block until every queued write has reached the database
+    def flush(self):
+        self._writes.join()
+
+    def _enqueue(self, record):
+        self._start()
+        with self._pending_lock:
+            self._pending[record["id"]] = record
+        self._writes.put(record)
+
+    def _summary(self, row):
+        return {
+            "id": row[0],
+            "created_at": row[1],
+            "updated_at": row[2],
+            "destination": row[3],
+            "num_days": row[4],
+            "budget": row[5],
+            "transport": row[6],
+        }
+
+    def _connect(self):
+        self._start()
+        return self._connection()
+
+    # One connection per thread; WAL lets readers proceed while the writer commits
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # Drain the write queue, committing whatever has accumulated in one transaction
+    def _write_loop(self):
+        conn = self._connection()
+        while True:
+            batch = [self._writes.get()]
+            while True:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with STAGE_SECONDS.time(stage="store_write"), conn:
+                    conn.executemany(
+                        """
+                        INSERT INTO itineraries
+                            (id, created_at, updated_at, destination, num_days, budget, transport, data)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                        """,
+                        [
+                            (r["id"], r["created_at"], r["updated_at"], r["destination"], r["num_days"],
+                             r["budget"], r["transport"], json.dumps(r["itinerary"]))
+                            for r in batch
+                        ],
+                    )
+            except sqlite3.Error as e:
+                print(f"Failed to write itineraries: {e}")
+            with self._pending_lock:
+                for record in batch:
+                    # Keep the newest version in memory if it was updated again meanwhile
+                    if self._pending.get(record["id"]) is record:
+                        del self._pending[record["id"]]
+            for _ in batch:
+                self._writes.task_done()
+
+itinerary_store = ItineraryStore(ITINERARY_DB)
+atexit.register(itinerary_store.flush)
+
+# Rendered export settings
+# Absolute, since send_file resolves relative paths against the app root rather than the working directory
+EXPORT_CACHE_DIR = os.path.abspath(os.getenv("EXPORT_CACHE_DIR", "export_cache"))
+EXPORT_CACHE_MAX_FILES = int(os.getenv("EXPORT_CACHE_MAX_FILES", 500))
+EXPORT_MAX_AGE = 60 * 60  # seconds browsers may reuse a rendered file without revalidating
+
+# Rendered files on disk, keyed by a content hash; the least recently used are removed past max_files
+class FileCache:
+    def __init__(self, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    # Path of a cached file, or None; a hit refreshes its place in the eviction order
+    def get(self, key, suffix):
+        path = self.path(key, suffix)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, suffix, data):
+        path = self.path(key, suffix)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        os.makedirs(self.directory, exist_ok=True)  # on first write, so importing the server creates nothing
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+        return path
+
+    def _evict(self):
+        with self._lock:
+            entries = [entry for entry in os.scandir(self.directory) if not entry.name.endswith(".tmp")]
+            if len(entries) <= self.max_files:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_files]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            try:
+                files = sum(1 for entry in os.scandir(self.directory) if not entry.name.endswith(".tmp"))
+            except FileNotFoundError:
+                files = 0  # nothing has been written yet
+            return {
+                "files": files,
+                "max_files": self.max_files,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+export_cache = FileCache(EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_FILES)
+
+# Hash of everything that affects the rendered output, used as cache key and ETag
+def export_key(kind, itinerary, options):
+    content = json.dumps({"kind": kind, "itinerary": itinerary, "options": options}, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+# Time every request by its route pattern, so ids in URLs do not multiply label values
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+
+@app.after_request
+def record_request_time(response):
+    if "request_started" in g:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - g.request_started,
+            endpoint=endpoint, method=request.method, status=response.status_code,
+        )
+    return response
+
+@app.teardown_request
+def finish_request(exception=None):
+    if "request_started" in g:
+        REQUESTS_IN_FLIGHT.dec()
+
 @app.route('/')
 def home():
     return "Backend is running!"
     
-# Load existing itinerary
+# List saved itineraries, newest first; pass next_cursor back as ?cursor= for the next page
 @app.route('/api/itinerary', methods=['GET'])
-def get_itinerary():
-    try:
-        with open("itinerary.json", "r", encoding="utf-8") as file:
-            itinerary_data = json.load(file)
-        return jsonify(itinerary_data)
-    except FileNotFoundError:
-        return jsonify({"error": "Itinerary file not found"}), 404
+def list_itineraries():
+    limit = request.args.get('limit', default=ITINERARY_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), ITINERARY_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor', type=int)
+    itineraries, next_cursor = itinerary_store.list(limit=limit, cursor=cursor)
+    return jsonify({"itineraries": itineraries, "next_cursor": next_cursor})
 
-# Function to call Gemini API using requests
-def generate_content(prompt):
-    api_key = os.getenv('GEMINI_API_KEY')
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}"
-    
-    # Prepare the request payload according to the API documentation
+# Load a saved itinerary
+@app.route('/api/itinerary/<itinerary_id>', methods=['GET'])
+def get_itinerary(itinerary_id):
+    record = itinerary_store.get(itinerary_id)
+    if record is None:
+        return jsonify({"error": "Itinerary not found"}), 404
+    return jsonify(record)
+
+# Replace a saved itinerary's days, e.g. after the client reorders activities
+@app.route('/api/itinerary/<itinerary_id>', methods=['PUT'])
+def update_itinerary(itinerary_id):
+    itinerary = (request.json or {}).get('itinerary')
+    if not isinstance(itinerary, list) or not all(isinstance(day, dict) for day in itinerary):
+        return jsonify({"error": "itinerary must be a list of days"}), 400
+    record = itinerary_store.update(itinerary_id, [normalize_day(day, i) for i, day in enumerate(itinerary)])
+    if record is None:
+        return jsonify({"error": "Itinerary not found"}), 404
+    return jsonify(record)
+
+# Saved itinerary as a PDF. Each distinct itinerary and option set is rendered once and
+# then streamed from the export cache; the content hash doubles as the ETag.
+@app.route('/api/itinerary/<itinerary_id>.pdf', methods=['GET'])
+def get_itinerary_pdf(itinerary_id):
+    record = itinerary_store.get(itinerary_id)
+    if record is None:
+        return jsonify({"error": "Itinerary not found"}), 404
+    options = export_options(record, request.args.get('style'))
+    key = export_key("pdf", record["itinerary"], options)
+    if key in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{key}"'})
+
+    path = export_cache.get(key, ".pdf")
+    if path is None:
+        try:
+            with STAGE_SECONDS.time(stage="pdf_render"):
+                data = render_pdf(record["itinerary"], **options)
+        except Exception as e:
+            print(f"Error rendering PDF: {e}")
+            return jsonify({"error": f"Failed to render PDF: {str(e)}"}), 500
+        path = export_cache.put(key, ".pdf", data)
+    return send_file(path, mimetype="application/pdf", as_attachment=True,
+                     download_name=export_filename(options["destination"], ".pdf"),
+                     etag=key, conditional=True, max_age=EXPORT_MAX_AGE)
+
+# Gemini HTTP client settings
+GEMINI_MODEL_URL = os.getenv("GEMINI_MODEL_URL", "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash")
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", 10))
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", 5))
+GEMINI_READ_TIMEOUT = float(os.getenv("GEMINI_READ_TIMEOUT", 60))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 3))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", 0.5))  # seconds
+GEMINI_BACKOFF_CAP = float(os.getenv("GEMINI_BACKOFF_CAP", 8))  # seconds
+GEMINI_MAX_RETRY_AFTER = float(os.getenv("GEMINI_MAX_RETRY_AFTER", 30))  # seconds
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", 20))
+GEMINI_CALL_BUDGET = float(os.getenv("GEMINI_CALL_BUDGET", 90))  # seconds for one call, retries included
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", 5))  # consecutive failed calls
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", 30))  # seconds before a probe call
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Raised when Gemini answers with an error status or cannot be reached
+class UpstreamError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+# Shared keep-alive client for the Gemini API with retries, hedged requests and a circuit
+# breaker that fails calls fast while Gemini keeps erroring or timing out
+class GeminiClient:
+    def __init__(self, pool_size=GEMINI_POOL_SIZE, timeout=(GEMINI_CONNECT_TIMEOUT, GEMINI_READ_TIMEOUT),
+                 max_retries=GEMINI_MAX_RETRIES, hedge_min_samples=GEMINI_HEDGE_MIN_SAMPLES,
+                 call_budget=GEMINI_CALL_BUDGET):
+        self.timeout = timeout
+        self.call_budget = call_budget
+        self.breaker = BREAKERS.get("gemini", failure_threshold=GEMINI_BREAKER_THRESHOLD,
+                                    reset_timeout=GEMINI_BREAKER_RESET, timeout=call_budget)
+        self.max_retries = max_retries
+        self.hedge_min_samples = hedge_min_samples
+        self.session = requests.Session()
+        # Upstream connections are bounded by _connections, whose wait is capped by the call's
+        # budget; the adapter itself never blocks, which would wait without any timeout
+        self._connections = threading.BoundedSemaphore(pool_size)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        # Hedged attempts get their own threads so they never wait behind a slow primary
+        self._hedge_pool = ThreadPoolExecutor(max_workers=pool_size * 4, thread_name_prefix="gemini-hedge")
+        self._latencies = deque(maxlen=200)
+        self._throttled_until = 0.0
+        self._lock = threading.Lock()
+
+    # 95th percentile of recent successful call latencies, or None until there is enough history
+    def p95_latency(self):
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    # Seconds until Gemini's most recent rate-limit response says to back off; batch work waits this out
+    def throttle_delay(self):
+        return max(0.0, self._throttled_until - time.monotonic())
+
+    # Raises CircuitOpenError without calling Gemini while its breaker is open
+    def post_json(self, url, payload):
+        return self.breaker.call(self._post_hedged, url, payload)
+
+    def _post_hedged(self, url, payload):
+        hedge_after = self.p95_latency()
+        if hedge_after is None:
+            return self._post_with_retries(url, payload)
+
+        primary = self._hedge_pool.submit(self._post_with_retries, url, payload)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        # The primary is slower than 95% of recent calls; race a second attempt against it
+        print(f"Gemini call exceeded p95 ({hedge_after:.2f}s), sending hedged request")
+        hedge = self._hedge_pool.submit(self._post_with_retries, url, payload)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        raise error
+
+    # Open a streaming request; retries only happen before the first byte of the body is read.
+    # The stream keeps its connection until it is closed.
+    def stream_lines(self, url, payload):
+        response = self.breaker.call(self._post_with_retries, url, payload, stream=True)
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if line:
+                    yield line
+        finally:
+            response.close()
+            self._connections.release()
+
+    def _post_with_retries(self, url, payload, stream=False):
+        attempt = 0
+        deadline = time.monotonic() + self.call_budget
+        while True:
+            # Waiting for a free connection counts against the call's budget like any other delay
+            if not self._connections.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                UPSTREAM_RESPONSES.inc(status="pool_timeout")
+                raise UpstreamError(f"API request failed: no free connection within {self.call_budget:.0f}s")
+            started = time.monotonic()
+            # Later attempts only get what is left of the call's budget
+            timeout = (self.timeout[0], max(1.0, min(self.timeout[1], deadline - started)))
+            try:
+                with UPSTREAM_IN_FLIGHT.track_inprogress():
+                    response = self.session.post(url, json=payload, timeout=timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._connections.release()
+                UPSTREAM_RESPONSES.inc(status="timeout" if isinstance(e, requests.Timeout) else "connection_error")
+                if attempt >= self.max_retries:
+                    raise UpstreamError(f"API request failed: {e}")
+                delay = self._backoff_delay(attempt)
+                print(f"API connection error: {e}; retrying in {delay:.2f}s")
+            else:
+                UPSTREAM_RESPONSES.inc(status=str(response.status_code))
+                if response.status_code == 200:
+                    if stream:
+                        return response  # stream_lines releases the connection once the stream closes
+                    self._connections.release()
+                    with self._lock:
+                        self._latencies.append(time.monotonic() - started)
+                    return response.json()
+                error_text = response.text  # read before the connection is handed back
+                response.close()
+                self._connections.release()
+                print(f"API Error: Status {response.status_code}")
+                print(f"Response: {error_text}")
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    raise UpstreamError(
+                        f"API request failed with status {response.status_code}: {error_text}",
+                        status_code=response.status_code,
+                    )
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                if response.status_code == 429:
+                    with self._lock:
+                        self._throttled_until = max(self._throttled_until, time.monotonic() + delay)
+                elif delay > GEMINI_MAX_RETRY_AFTER:
+                    # Waiting that long would only tie up the worker; fail now instead
+                    raise UpstreamError(
+                        f"API request failed with status {response.status_code}: retry after {delay:.0f}s",
+                        status_code=response.status_code,
+                    )
+            if time.monotonic() + delay >= deadline:
+                raise UpstreamError(f"API request failed: gave up after {attempt + 1} attempts within "
+                                    f"{self.call_budget:.0f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    # Full-jitter exponential backoff
+    def _backoff_delay(self, attempt):
+        return random.uniform(0, min(GEMINI_BACKOFF_CAP, GEMINI_BACKOFF_BASE * (2 ** attempt)))
+
+    # Retry-After may be given in seconds or as an HTTP date
+    def _retry_after(self, response):
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+gemini_client = GeminiClient()
+usage_tracker = UsageTracker()
+
+# Add a call's usageMetadata to its request's meter, the usage aggregates and the metrics
+def record_usage(meter, metadata, seconds, days=0):
+    prompt_tokens, output_tokens = meter.record(metadata, seconds, days)
+    GEMINI_TOKENS.inc(prompt_tokens, kind=meter.kind, type="prompt")
+    GEMINI_TOKENS.inc(output_tokens, kind=meter.kind, type="output")
+    GEMINI_COST.inc(estimate_cost(prompt_tokens, output_tokens), kind=meter.kind)
+
+# Payload for a single-prompt call. With a token budget, maxOutputTokens stops the model
+# once the call has spent its reservation.
+def build_payload(prompt, generation_config, meter, reservation):
     payload = {
         "contents": [{
             "parts": [{"text": prompt}]
         }]
     }
-    
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    
-    # Make the API request
-    response = requests.post(url, headers=headers, json=payload)
-    
-    # Check if the request was successful
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"API Error: Status {response.status_code}")
-        print(f"Response: {response.text}")
-        raise Exception(f"API request failed with status {response.status_code}: {response.text}")
+    max_output = meter.max_output_tokens(prompt, reservation)
+    if max_output is not None:
+        generation_config = dict(generation_config or {}, maxOutputTokens=max_output)
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    return payload
 
-# Helper function to parse the text response into JSON
-def parse_itinerary_to_json(text):
+# Function to call Gemini API through the shared client. days is how many itinerary days
+# the prompt asks for, so usage can be related to trip length.
+def generate_content(prompt, generation_config=None, meter=None, days=0):
+    api_key = os.getenv('GEMINI_API_KEY')
+    url = f"{GEMINI_MODEL_URL}:generateContent?key={api_key}"
+    meter = meter or UsageMeter(usage_tracker, "other")
+    reservation = meter.reserve(prompt, days)
     try:
-        # Find JSON content (it might be surrounded by markdown code blocks)
-        json_match = re.search(r'```json\s*([\s\S]*?)\s*```', text)
-        if json_match:
-            json_text = json_match.group(1)
-        else:
-            # If not in code blocks, try to find array directly
-            json_match = re.search(r'\[\s*{[\s\S]*}\s*\]', text)
-            if json_match:
-                json_text = json_match.group(0)
+        payload = build_payload(prompt, generation_config, meter, reservation)
+        started = time.perf_counter()
+        with STAGE_SECONDS.time(stage="upstream"):
+            result = gemini_client.post_json(url, payload)
+        record_usage(meter, result.get("usageMetadata"), time.perf_counter() - started, days)
+    finally:
+        meter.release(reservation)
+    if meter.limit is not None and finish_reason(result) == "MAX_TOKENS":
+        raise TokenBudgetExceeded(f"Request token budget of {meter.limit} used up before the response was complete")
+    return result
+
+def finish_reason(result):
+    try:
+        return result["candidates"][0].get("finishReason")
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+# Stream generated text from Gemini, yielding text fragments as they arrive. Usage is
+# recorded when the stream ends, however it ends (the last usageMetadata seen holds the
+# running totals).
+def stream_content(prompt, meter=None, days=0):
+    api_key = os.getenv('GEMINI_API_KEY')
+    url = f"{GEMINI_MODEL_URL}:streamGenerateContent?alt=sse&key={api_key}"
+    meter = meter or UsageMeter(usage_tracker, "other")
+    reservation = meter.reserve(prompt, days)
+    payload = build_payload(prompt, None, meter, reservation)
+
+    started = time.perf_counter()
+    first_chunk = True
+    metadata = None
+    try:
+        for line in gemini_client.stream_lines(url, payload):
+            # Server-sent events: only "data:" lines carry response chunks
+            if not line.startswith("data:"):
+                continue
+            if first_chunk:
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage="upstream_first_chunk")
+                first_chunk = False
+            chunk = json.loads(line[len("data:"):])
+            metadata = chunk.get("usageMetadata") or metadata
+            for candidate in chunk.get("candidates", []):
+                if candidate.get("finishReason") == "MAX_TOKENS" and meter.limit is not None:
+                    raise TokenBudgetExceeded(f"Request token budget of {meter.limit} used up while streaming")
+                for part in candidate.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
+    finally:
+        if not first_chunk:
+            record_usage(meter, metadata, time.perf_counter() - started, days)
+        meter.release(reservation)
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage="upstream_stream")
+
+# Fix day numbering issues and missing fields on a parsed day
+def normalize_day(day, index):
+    if "day" not in day:
+        day["day"] = f"Day {index+1}"
+    elif day["day"] == "Day 0":  # Fix "Day 0" issue
+        day["day"] = f"Day {index+1}"
+
+    if "activities" not in day:
+        day["activities"] = []
+    return day
+
+# Structural characters the itinerary scanner has to look at; everything else is copied in bulk
+JSON_TOKEN = re.compile(r'[\[\]{}",]')
+# Remainder of a JSON string up to and including its closing quote
+STRING_TAIL = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+JSON_DECODER = json.JSONDecoder()
+# json raises RecursionError for very deeply nested input; model output that does so is malformed
+JSON_ERRORS = (ValueError, RecursionError)
+
+# Single-pass scanner for the JSON array of days in model output. It works on a whole
+# response or incrementally on streamed chunks, returning each day as soon as it closes.
+# Code fences and other text before the array are skipped, trailing commas are dropped,
+# and finish() repairs a truncated last day or drops it if nothing usable is left.
+class ItineraryScanner:
+    def __init__(self):
+        self.days = []
+        self.repaired = False
+        self._state = "seek"  # seek -> open (after "[") -> array -> done
+        self._stack = []  # closers for the brackets open inside the current day
+        self._parts = []  # text of the current day
+        self._length = 0
+        self._in_string = False
+        self._escaped = False  # the previous chunk ended with a backslash inside a string
+        self._comma = False  # comma held back until we know it is not a trailing comma
+        self._gap = ""  # text seen after a held-back comma
+        self._cut = None  # (length, closers) of the last point where the day could be closed
+        # A failed decode costs time proportional to its offset in the chunk (the error counts
+        # lines from the start), so once one day turns out malformed the rest are scanned by hand
+        self._malformed = False
+
+    def feed(self, chunk):
+        completed = []
+        decode_failed = False  # the day being scanned failed to decode and may still close in this chunk
+        pos = self._find_array(chunk, 0)
+        if pos is None:
+            return completed
+
+        i = pos
+        if self._escaped:
+            i += 1  # the character after a backslash that ended the previous chunk
+            self._escaped = False
+        while True:
+            if self._in_string:
+                match = STRING_TAIL.match(chunk, i)
+                if match is None:
+                    # The string continues in the next chunk; note if it stops mid-escape
+                    tail = chunk[i:]
+                    self._escaped = (len(tail) - len(tail.rstrip("\\"))) % 2 == 1
+                    break
+                i = match.end()
+                self._in_string = False
+                continue
+
+            match = JSON_TOKEN.search(chunk, i)
+            if match is None:
+                break
+            i = match.start()
+            ch = chunk[i]
+
+            if not self._stack:
+                # Between days: only the start of the next day or the end of the array matters
+                if ch == "{" and not self._malformed:
+                    # Well-formed days are decoded in one go; malformed or split ones are scanned
+                    try:
+                        element, i = JSON_DECODER.raw_decode(chunk, i)
+                    except JSON_ERRORS:
+                        decode_failed = True
+                    else:
+                        day = self._add_day(element)
+                        if day is not None:
+                            completed.append(day)
+                        continue
+                if ch in "{[":
+                    self._stack.append("}" if ch == "{" else "]")
+                    pos = i
+                elif ch == "]":
+                    self._state = "done"
+                    return completed
+                elif ch == '"':
+                    self._in_string = True
+                i += 1
+                continue
+
+            if self._comma:
+                self._resolve_comma(chunk[pos:i], ch)
+                pos = i
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._stack.append("}" if ch == "{" else "]")
+            elif ch in "}]":
+                self._stack.pop()
+                self._append(chunk[pos:i + 1])
+                pos = i + 1
+                if not self._stack:
+                    # Closing in the chunk it failed to decode in means malformed rather than split
+                    self._malformed = self._malformed or decode_failed
+                    day = self._complete_day()
+                    if day is not None:
+                        completed.append(day)
+                else:
+                    self._cut = (self._length, "".join(reversed(self._stack)))
+            elif ch == ",":
+                self._append(chunk[pos:i])
+                pos = i + 1
+                self._cut = (self._length, "".join(reversed(self._stack)))
+                self._comma = True
+            i += 1
+
+        if self._stack:
+            if self._comma:
+                self._gap += chunk[pos:]
             else:
-                # If no clear JSON pattern, try the whole text
-                json_text = text
-                
-        # Clean up the text
-        json_text = json_text.strip()
-        
-        # Parse JSON
-        itinerary = json.loads(json_text)
-        
-        # Validate the itinerary format
-        if isinstance(itinerary, list):
-            # Fix any day numbering issues
-            for i, day in enumerate(itinerary):
-                if "day" not in day:
-                    day["day"] = f"Day {i+1}"
-                elif day["day"] == "Day 0":  # Fix "Day 0" issue
-                    day["day"] = f"Day {i+1}"
-                
-                if "activities" not in day:
-                    day["activities"] = []
-                    
-            return itinerary
+                self._append(chunk[pos:])
+        return completed
+
+    # Close a truncated last day at its last complete value, or drop it
+    def finish(self):
+        day = None
+        if self._stack and self._cut is not None:
+            length, closers = self._cut
+            try:
+                element = json.loads("".join(self._parts)[:length] + closers)
+            except JSON_ERRORS:
+                element = None
+            if isinstance(element, dict) and isinstance(element.get("activities"), list):
+                activities = [
+                    activity for activity in element["activities"]
+                    if isinstance(activity, dict) and "time" in activity and "activity" in activity
+                ]
+                if activities:
+                    element["activities"] = activities
+                    day = self._add_day(element)
+                    self.repaired = True
+        self._reset_day()
+        self._state = "done"
+        return day
+
+    # Skip ahead to the first "[" that opens an array of objects; returns where scanning resumes
+    def _find_array(self, chunk, pos):
+        while self._state in ("seek", "open"):
+            if self._state == "seek":
+                start = chunk.find("[", pos)
+                if start < 0:
+                    return None
+                self._state = "open"
+                pos = start + 1
+            while pos < len(chunk) and chunk[pos].isspace():
+                pos += 1
+            if pos == len(chunk):
+                return None
+            if chunk[pos] == "{":
+                self._state = "array"
+            elif chunk[pos] == "]":
+                self._state = "done"
+            else:
+                self._state = "seek"
+        return pos if self._state == "array" else None
+
+    def _resolve_comma(self, text, next_char):
+        gap = self._gap + text
+        if next_char in "}]" and not gap.strip():
+            self._append(gap)  # trailing comma: drop it
         else:
-            raise ValueError("Itinerary is not a list")
-            
-    except Exception as e:
-        print(f"JSON parsing error: {e}")
+            self._append("," + gap)
+        self._comma = False
+        self._gap = ""
+
+    def _append(self, text):
+        if text:
+            self._parts.append(text)
+            self._length += len(text)
+
+    def _reset_day(self):
+        self._stack = []
+        self._parts = []
+        self._length = 0
+        self._in_string = False
+        self._comma = False
+        self._gap = ""
+        self._cut = None
+
+    def _complete_day(self):
+        text = "".join(self._parts)
+        self._reset_day()
+        try:
+            element = json.loads(text)
+        except JSON_ERRORS as e:
+            print(f"Skipping unparseable day: {e}")
+            return None
+        return self._add_day(element)
+
+    def _add_day(self, element):
+        if not isinstance(element, dict):
+            return None
+        day = normalize_day(element, len(self.days))
+        self.days.append(day)
+        return day
+
+# Helper function to parse the text response into JSON
+def parse_itinerary_to_json(text):
+    with STAGE_SECONDS.time(stage="parse"):
+        scanner = ItineraryScanner()
+        scanner.feed(text)
+        scanner.finish()
+    if not scanner.days:
+        PARSE_FAILURES.inc(kind="itinerary")
         print(f"Raw text: {text}")
-        raise ValueError(f"Failed to parse itinerary JSON: {str(e)}")
+        raise ValueError("Failed to parse itinerary JSON: no itinerary days found in response")
+    if scanner.repaired:
+        print("Response was truncated; repaired the last day")
+    return scanner.days
 
-@app.route('/api/itinerary/generate', methods=['POST'])
-def generate_itinerary():
-    try:
-        data = request.json
-        destination = data.get('destination')
-        num_days = data.get('num_days')
-        budget = data.get('budget')
-        transport = data.get('transport')
-        
-        # Generate prompt
-        prompt = f"""Generate a detailed {num_days}-day travel itinerary for {destination} with a {budget} budget, using {transport}.
+# Build the itinerary prompt for the model; chunks of a longer trip pass their first day and the trip outline
+def build_itinerary_prompt(destination, num_days, budget, transport, first_day=1, context=""):
+    return f"""Generate a detailed {num_days}-day travel itinerary for {destination} with a {budget} budget, using {transport}.
+        {context}
 
         Return ONLY a valid JSON array with the following structure. DO NOT include any explanations, markdown formatting, or text outside the JSON:
         [
         {{
-            "day": "Day 1",
+            "day": "Day {first_day}",
             "activities": [
             {{
                 "time": "Morning",
@@ -133,40 +1054,1194 @@ def generate_itinerary():
 
         IMPORTANT:
         - Return ONLY the JSON array, no other text
-        - Format days as "Day 1", "Day 2", etc. (NOT "Day 0")
+        - Format days as "Day {first_day}", "Day {first_day + 1}", etc. (NOT "Day 0")
         - Include at least 3 activities per day
         - The response must be valid JSON that can be parsed with json.loads()
         """
 
-        print(f"Sending prompt to Gemini API")
-        
-        # Call Gemini API
-        result = generate_content(prompt)
-        
-        # Process the response - extract text from the Gemini 2.0 response format
+# Extract the generated text from a Gemini response
+def extract_response_text(result):
+    try:
+        return result["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        print(f"Response structure: {json.dumps(result, indent=2)}")
+        raise ValueError("Unexpected response structure from Gemini API")
+
+# How long a coalesced caller waits for the shared generation before giving up
+FLIGHT_WAIT_TIMEOUT = float(os.getenv("FLIGHT_WAIT_TIMEOUT", 300))  # seconds
+
+# One upstream generation shared by every concurrent caller with the same trip key
+class Flight:
+    def __init__(self):
+        self.days = []  # days published so far by a streaming leader
+        self.result = None
+        self.error = None
+        self.done = False
+        self._cond = threading.Condition()
+
+    def publish(self, day):
+        with self._cond:
+            self.days.append(day)
+            self._cond.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self._cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    # Block until the leader finishes and return its itinerary or raise its error
+    def wait(self, timeout=FLIGHT_WAIT_TIMEOUT):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.done, timeout=timeout):
+                raise TimeoutError("Timed out waiting for an identical in-flight request")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    # Yield days as the leader publishes them, then any it only returned at the end
+    def follow(self, timeout=FLIGHT_WAIT_TIMEOUT):
+        seen = 0
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: self.done or len(self.days) > seen, timeout=timeout):
+                    raise TimeoutError("Timed out waiting for an identical in-flight request")
+                new_days = self.days[seen:]
+                done = self.done
+            for day in new_days:
+                yield day
+            seen += len(new_days)
+            if done:
+                break
+        if self.error is not None:
+            raise self.error
+        for day in (self.result or [])[seen:]:
+            yield day
+
+# Coalesces concurrent generations of the same trip into a single upstream call
+class SingleFlight:
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    # Returns (flight, is_leader); only the leader calls the model
+    def join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    # Called by the leader exactly once, after the result has been cached
+    def leave(self, key, flight, result=None, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(result, error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "upstream_calls": self.leaders,
+                "upstream_calls_saved": self.coalesced,
+            }
+
+generation_flights = SingleFlight()
+
+# Abandoned generators (e.g. a client disconnecting mid-stream) must still release their followers
+def flight_error(e):
+    return e if isinstance(e, Exception) else UpstreamError("Generation was cancelled")
+
+# Trip size limits; trips longer than CHUNK_DAYS are generated as chunks running in parallel
+MAX_TRIP_DAYS = int(os.getenv("MAX_TRIP_DAYS", 30))
+CHUNK_DAYS = int(os.getenv("CHUNK_DAYS", 5))
+CHUNK_FANOUT = int(os.getenv("CHUNK_FANOUT", 6))
+CHUNK_RETRIES = int(os.getenv("CHUNK_RETRIES", 1))  # extra attempts for a chunk that comes back short
+
+# Raised for trip parameters the planner cannot handle
+class InvalidTripError(Exception):
+    pass
+
+def parse_num_days(value):
+    try:
+        num_days = int(value)
+    except (TypeError, ValueError):
+        raise InvalidTripError("num_days must be a whole number of days")
+    if num_days < 1:
+        raise InvalidTripError("num_days must be at least 1")
+    return num_days
+
+# Validate request parameters into a trip; multi-city trips list their stops under "legs"
+def parse_trip(data):
+    legs = data.get('legs')
+    if legs:
+        if not isinstance(legs, list) or not all(isinstance(leg, dict) and leg.get('destination') for leg in legs):
+            raise InvalidTripError("legs must be a list of {destination, num_days} objects")
+        legs = [{"destination": leg['destination'], "num_days": parse_num_days(leg.get('num_days'))} for leg in legs]
+        destination = data.get('destination') or ", ".join(leg['destination'] for leg in legs)
+        num_days = sum(leg['num_days'] for leg in legs)
+    else:
+        destination = data.get('destination')
+        num_days = parse_num_days(data.get('num_days'))
+        legs = [{"destination": destination, "num_days": num_days}]
+    if num_days > MAX_TRIP_DAYS:
+        raise InvalidTripError(f"Trips are limited to {MAX_TRIP_DAYS} days")
+    return {
+        "destination": destination,
+        "num_days": num_days,
+        "budget": data.get('budget'),
+        "transport": data.get('transport'),
+        "legs": legs,
+    }
+
+# Usage reporting and billing settings
+APP_API_TOKEN = os.getenv("APP_API_TOKEN", "")  # shared secret the Streamlit app sends as X-App-Token
+USAGE_REPORT_MAX_TOKENS = int(os.getenv("USAGE_REPORT_MAX_TOKENS", 200_000))  # per reported answer
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", 0))  # proxies in front of the server that set X-Forwarded-For
+
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Whether the request comes from the Streamlit app, which proves it with the shared APP_API_TOKEN
+def from_app():
+    token = request.headers.get("X-App-Token", "")
+    return bool(APP_API_TOKEN) and hmac.compare_digest(token.encode("utf-8"), APP_API_TOKEN.encode("utf-8"))
+
+# Who a request is billed to: the browser session the app names in X-Client-Id, which is only
+# trusted alongside the app's token, else the caller's address (behind TRUSTED_PROXIES proxies)
+def request_client():
+    session_id = request.headers.get("X-Client-Id")
+    if session_id and from_app():
+        return f"session:{session_id[:64]}"
+    return request.remote_addr or "unknown"
+
+# Meter for one request. Its budget is the tightest of the server's per-request ceiling, the
+# request's own max_tokens and what is left of the client's allowance; raises
+# TokenBudgetExceeded if the client has nothing left.
+def request_meter(kind, trip, data=None, client=None):
+    client = client or request_client()
+    usage_tracker.check_client(client)
+    limits = [USAGE_REQUEST_TOKEN_LIMIT, usage_tracker.client_remaining(client)]
+    max_tokens = (data or {}).get('max_tokens')
+    if max_tokens is not None:
+        try:
+            max_tokens = int(max_tokens)
+        except (TypeError, ValueError):
+            raise InvalidTripError("max_tokens must be a whole number of tokens")
+        if max_tokens < 1:
+            raise InvalidTripError("max_tokens must be at least 1")
+        limits.append(max_tokens)
+    limits = [limit for limit in limits if limit]
+    return UsageMeter(usage_tracker, kind, trip.get("destination"), trip.get("num_days"), client,
+                      limit=min(limits) if limits else None)
+
+# Shorten a trip to the days its token budget is expected to cover, going by the tokens
+# recent generations spent per day. The original length is kept as requested_days.
+def cap_trip_days(trip, meter):
+    if meter.limit is None:
+        return trip
+    affordable = meter.limit // usage_tracker.tokens_per_day()
+    if affordable < 1:
+        raise TokenBudgetExceeded(f"A token budget of {meter.limit} is not enough to plan a single day")
+    if trip["num_days"] <= affordable:
+        return trip
+    legs = []
+    days_left = affordable
+    for leg in trip["legs"]:
+        if days_left <= 0:
+            break
+        legs.append(dict(leg, num_days=min(leg["num_days"], days_left)))
+        days_left -= legs[-1]["num_days"]
+    print(f"Capping {trip['num_days']}-day trip to {affordable} days for a budget of {meter.limit} tokens")
+    meter.num_days = affordable
+    return dict(trip, num_days=affordable, legs=legs, requested_days=trip["num_days"])
+
+# Response fields with what a request used, and its original length if it was capped
+def usage_fields(trip, meter):
+    fields = {"usage": {
+        "prompt_tokens": meter.prompt_tokens,
+        "output_tokens": meter.output_tokens,
+        "cost_usd": round(estimate_cost(meter.prompt_tokens, meter.output_tokens), 6),
+    }}
+    if "requested_days" in trip:
+        fields["requested_days"] = trip["requested_days"]
+    return fields
+
+# Out of tokens: 429 with Retry-After for a client's allowance, 422 for a request's own budget
+def budget_response(e):
+    response = jsonify({"error": str(e)})
+    if e.retry_after is None:
+        return response, 422
+    response.headers["Retry-After"] = str(max(1, round(e.retry_after)))
+    return response, 429
+
+# Split a trip into evenly sized chunks of at most CHUNK_DAYS days, never spanning two cities
+def plan_chunks(trip):
+    chunks = []
+    start_day = 1
+    for leg in trip["legs"]:
+        parts = -(-leg["num_days"] // CHUNK_DAYS)
+        size, extra = divmod(leg["num_days"], parts)
+        for part in range(parts):
+            num_days = size + (1 if part < extra else 0)
+            chunks.append({
+                "destination": leg["destination"],
+                "start_day": start_day,
+                "num_days": num_days,
+                "part": part + 1,
+                "parts": parts,
+            })
+            start_day += num_days
+    return chunks
+
+# Short outline shared by every chunk so they agree on where the traveller is and when
+def build_chunk_context(trip, chunk):
+    stops = []
+    start_day = 1
+    for leg in trip["legs"]:
+        stops.append(f"Days {start_day}-{start_day + leg['num_days'] - 1} in {leg['destination']}")
+        start_day += leg["num_days"]
+    stops = ", ".join(stops)
+    last_day = chunk["start_day"] + chunk["num_days"] - 1
+    lines = [
+        f"This is part of a {trip['num_days']}-day trip ({stops}); the budget above is for the whole trip.",
+        f"Plan only days {chunk['start_day']} to {last_day}.",
+    ]
+    if chunk["parts"] > 1:
+        lines.append(
+            f"This is part {chunk['part']} of {chunk['parts']} for {chunk['destination']}; other parts are planned "
+            f"separately, so focus on different neighbourhoods and sights from the rest of the stay."
+        )
+    if chunk["start_day"] == 1:
+        lines.append("Day 1 is the arrival day.")
+    elif chunk["part"] == 1:
+        lines.append(f"Day {chunk['start_day']} starts with travel to {chunk['destination']}.")
+    if last_day == trip["num_days"]:
+        lines.append(f"Day {last_day} is the departure day.")
+    return "\n        ".join(lines)
+
+def generate_chunk(trip, chunk, meter=None):
+    with STAGE_SECONDS.time(stage="prompt_build"):
+        prompt = build_itinerary_prompt(
+            chunk["destination"], chunk["num_days"], trip["budget"], trip["transport"],
+            first_day=chunk["start_day"], context=build_chunk_context(trip, chunk),
+        )
+    for attempt in range(CHUNK_RETRIES + 1):
+        result = generate_content(prompt, meter=meter, days=chunk["num_days"])
+        days = parse_itinerary_to_json(extract_response_text(result))[:chunk["num_days"]]
+        if len(days) == chunk["num_days"]:
+            break
+        print(f"Chunk from day {chunk['start_day']} returned {len(days)} of {chunk['num_days']} days"
+              + ("; retrying" if attempt < CHUNK_RETRIES else ""))
+    else:
+        # A short chunk would leave a silent gap in the trip
+        raise ValueError(f"Failed to generate days {chunk['start_day']}-{chunk['start_day'] + chunk['num_days'] - 1}: "
+                         f"got {len(days)} of {chunk['num_days']} days")
+    for i, day in enumerate(days):
+        day["day"] = f"Day {chunk['start_day'] + i}"
+        if len(trip["legs"]) > 1:
+            day["city"] = chunk["destination"]
+    return days
+
+# Generate all chunks with bounded fan-out, yielding each chunk's days in trip order
+def generate_chunks(trip, chunks, meter=None):
+    print(f"Generating {trip['num_days']}-day trip as {len(chunks)} chunks")
+    pool = ThreadPoolExecutor(max_workers=min(CHUNK_FANOUT, len(chunks)), thread_name_prefix="chunk")
+    try:
+        futures = [pool.submit(generate_chunk, trip, chunk, meter) for chunk in chunks]
+        for future in futures:
+            yield future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+# Generate a whole itinerary with non-streaming calls
+def generate_itinerary_days(trip, meter=None):
+    chunks = plan_chunks(trip)
+    if len(chunks) > 1:
+        return [day for days in generate_chunks(trip, chunks, meter) for day in days]
+
+    with STAGE_SECONDS.time(stage="prompt_build"):
+        prompt = build_itinerary_prompt(trip["destination"], trip["num_days"], trip["budget"], trip["transport"])
+
+    print(f"Sending prompt to Gemini API")
+    result = generate_content(prompt, meter=meter, days=trip["num_days"])
+
+    text_response = extract_response_text(result)
+    print("Raw API response:", text_response)  # Debugging
+
+    itinerary = parse_itinerary_to_json(text_response)
+    print("Parsed JSON:", itinerary)  # Debugging
+    return itinerary
+
+# Yield days one at a time as they are generated: streamed for short trips, chunk by chunk for long ones
+def stream_generated_days(trip, meter=None):
+    chunks = plan_chunks(trip)
+    if len(chunks) > 1:
+        for days in generate_chunks(trip, chunks, meter):
+            yield from days
+        return
+
+    with STAGE_SECONDS.time(stage="prompt_build"):
+        prompt = build_itinerary_prompt(trip["destination"], trip["num_days"], trip["budget"], trip["transport"])
+
+    print(f"Streaming prompt to Gemini API")
+    scanner = ItineraryScanner()
+    for text in stream_content(prompt, meter=meter, days=trip["num_days"]):
+        yield from scanner.feed(text)
+    day = scanner.finish()
+    if day is not None:
+        yield day
+    if not scanner.days:
+        PARSE_FAILURES.inc(kind="itinerary_stream")
+
+# Return (itinerary, cache_status); a cache hit skips the model call entirely. before_generate
+# runs only when this call is about to generate, not for hits or coalesced waits.
+def build_itinerary(trip, meter=None, before_generate=None):
+    cache_key = normalize_trip_key(trip)
+    while True:
+        itinerary = itinerary_cache.get(cache_key)
+        if itinerary is not None:
+            CACHE_REQUESTS.inc(result="hit")
+            print(f"Cache hit for {cache_key}")
+            return itinerary, "HIT"
+
+        flight, is_leader = generation_flights.join(cache_key)
+        if is_leader:
+            break
+        CACHE_REQUESTS.inc(result="coalesced")
+        print(f"Joining in-flight generation for {cache_key}")
+        try:
+            return flight.wait(), "COALESCED"
+        except TokenBudgetExceeded:
+            # The leader's budget ran out, not this request's: try again with this one's own
+            print(f"In-flight generation for {cache_key} ran out of its token budget, retrying")
+    CACHE_REQUESTS.inc(result="miss")
+
+    try:
+        if before_generate is not None:
+            before_generate()
+        itinerary = generate_itinerary_days(trip, meter)
+        itinerary_cache.set(cache_key, itinerary)
+    except BaseException as e:
+        generation_flights.leave(cache_key, flight, error=flight_error(e))
+        raise
+    generation_flights.leave(cache_key, flight, result=itinerary)
+    return itinerary, "MISS"
+
+# Yield (day, cache_status) pairs as each day of the itinerary becomes available
+def stream_itinerary_days(trip, meter=None):
+    cache_key = normalize_trip_key(trip)
+    sent = 0  # days already yielded, which a retry after a leader's budget ran out skips
+    while True:
+        itinerary = itinerary_cache.get(cache_key)
+        if itinerary is not None:
+            CACHE_REQUESTS.inc(result="hit")
+            print(f"Cache hit for {cache_key}")
+            for day in itinerary[sent:]:
+                yield day, "HIT"
+            return
+
+        flight, is_leader = generation_flights.join(cache_key)
+        if is_leader:
+            break
+        CACHE_REQUESTS.inc(result="coalesced")
+        print(f"Joining in-flight generation for {cache_key}")
+        try:
+            for index, day in enumerate(flight.follow()):
+                if index >= sent:
+                    sent += 1
+                    yield day, "COALESCED"
+            return
+        except TokenBudgetExceeded:
+            # The leader's budget ran out, not this request's: try again with this one's own
+            print(f"In-flight generation for {cache_key} ran out of its token budget, retrying")
+    CACHE_REQUESTS.inc(result="miss")
+
+    itinerary = []
+    try:
+        for day in stream_generated_days(trip, meter):
+            itinerary.append(day)
+            flight.publish(day)
+            if len(itinerary) > sent:
+                yield day, "MISS"
+
+        if not itinerary:
+            raise ValueError("Failed to parse itinerary JSON: no complete days in streamed response")
+        itinerary_cache.set(cache_key, itinerary)
+    except BaseException as e:
+        generation_flights.leave(cache_key, flight, error=flight_error(e))
+        raise
+    generation_flights.leave(cache_key, flight, result=itinerary)
+
+# Persist a generated itinerary along with the trip it was made from
+def save_itinerary(itinerary, trip):
+    return itinerary_store.save(
+        itinerary,
+        destination=trip["destination"],
+        num_days=trip["num_days"],
+        budget=trip["budget"],
+        transport=trip["transport"],
+    )
+
+# Small edits need no reasoning, so skip thinking and ask for JSON directly
+REGENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "thinkingConfig": {"thinkingBudget": 0},
+}
+
+# (start, end) of every bracketed value in text that closes, in the order they open. Quotes
+# only start strings inside brackets, so apostrophes and quotes in surrounding prose are text.
+def bracket_spans(text):
+    spans, opened = [], []
+    i = 0
+    while True:
+        match = JSON_TOKEN.search(text, i)
+        if match is None:
+            break
+        i = match.start()
+        ch = text[i]
+        if ch == '"' and opened:
+            match = STRING_TAIL.match(text, i + 1)
+            if match is None:
+                break
+            i = match.end()
+            continue
+        if ch in "{[":
+            opened.append(i)
+        elif ch in "}]" and opened:
+            spans.append((opened.pop(), i + 1))
+        i += 1
+    return sorted(spans)
+
+# Parse the first JSON object in a model response, ignoring code fences and surrounding text.
+# Each candidate is decoded on its own slice and skipped whole if malformed, so a failed
+# decode never rescans the text before it or the objects nested inside it.
+def parse_json_object(text):
+    skip_to = 0
+    for start, end in bracket_spans(text):
+        if text[start] != "{" or start < skip_to:
+            continue
+        try:
+            return json.loads(text[start:end])
+        except JSON_ERRORS:
+            skip_to = end
+    PARSE_FAILURES.inc(kind="object")
+    print(f"Raw text: {text}")
+    raise ValueError("Failed to parse JSON object from response")
+
+# Find the activity for a slot given as a time label ("Morning") or a 0-based index
+def find_activity_index(activities, slot):
+    if isinstance(slot, int) or (isinstance(slot, str) and slot.isdigit()):
+        index = int(slot)
+        return index if 0 <= index < len(activities) and isinstance(activities[index], dict) else None
+    for index, activity in enumerate(activities):
+        if isinstance(activity, dict) and str(activity.get("time", "")).strip().lower() == str(slot).strip().lower():
+            return index
+    return None
+
+# One line per other day so the model can avoid repeating what is already planned
+def summarize_other_days(itinerary, skip_index, max_chars=80):
+    lines = []
+    for i, day in enumerate(itinerary):
+        if i == skip_index or not isinstance(day, dict):
+            continue
+        activities = "; ".join(
+            str(activity.get("activity", ""))[:max_chars]
+            for activity in day.get("activities", []) if isinstance(activity, dict)
+        )
+        lines.append(f"- {day.get('day', f'Day {i+1}')}: {activities}")
+    return "\n".join(lines) or "- (none)"
+
+# Prompt carrying only the part being replaced plus a one-line summary of the other days
+def build_regeneration_prompt(trip, itinerary, day_index, activity_index, instruction):
+    day = itinerary[day_index]
+    instruction = instruction or "Suggest a different alternative."
+    header = (
+        f"You are revising part of a {len(itinerary)}-day travel itinerary for {trip.get('destination')} "
+        f"with a {trip.get('budget')} budget, using {trip.get('transport')}.\n"
+        f"Other days already planned (do not repeat these):\n{summarize_other_days(itinerary, day_index)}\n"
+    )
+    if activity_index is None:
+        return f"""{header}
+        Replace {day.get('day')}, currently:
+        {json.dumps(day)}
+
+        Instruction: {instruction}
+
+        Return ONLY a JSON object with the same structure ("day", "activities" with "time" and "activity", "budget", "transport").
+        Keep "day" as "{day.get('day')}" and include at least 3 activities.
+        """
+    activity = day["activities"][activity_index]
+    return f"""{header}
+        Replace this {activity.get('time')} activity on {day.get('day')}:
+        {json.dumps(activity)}
+        The rest of that day: {json.dumps([a for i, a in enumerate(day['activities']) if i != activity_index])}
+
+        Instruction: {instruction}
+
+        Return ONLY a JSON object of the form {{"time": "{activity.get('time')}", "activity": "Description"}}.
+        """
+
+# Regenerate one day (or one activity slot in it) and return a new itinerary with it spliced in
+def regenerate_part(trip, itinerary, day_number, slot=None, instruction=None, meter=None):
+    day_index = day_number - 1
+    if not 0 <= day_index < len(itinerary) or not isinstance(itinerary[day_index], dict):
+        raise LookupError(f"Day {day_number} is not in this itinerary")
+    activity_index = None
+    if slot is not None:
+        activities = itinerary[day_index].get("activities")
+        activity_index = find_activity_index(activities, slot) if isinstance(activities, list) else None
+        if activity_index is None:
+            raise LookupError(f"Activity slot {slot!r} is not in day {day_number}")
+
+    prompt = build_regeneration_prompt(trip, itinerary, day_index, activity_index, instruction)
+    print(f"Regenerating day {day_number}" + (f" slot {slot}" if slot is not None else ""))
+    replacement = parse_json_object(extract_response_text(generate_content(prompt, REGENERATION_CONFIG, meter=meter)))
+
+    updated = [dict(day) if isinstance(day, dict) else day for day in itinerary]
+    if activity_index is None:
+        replacement = normalize_day(replacement, day_index)
+        replacement["day"] = itinerary[day_index].get("day", replacement["day"])
+        updated[day_index] = replacement
+    else:
+        if "activity" not in replacement:
+            raise ValueError("Regenerated activity is missing its description")
+        replacement.setdefault("time", itinerary[day_index]["activities"][activity_index].get("time"))
+        activities = list(updated[day_index]["activities"])
+        activities[activity_index] = replacement
+        updated[day_index]["activities"] = activities
+    return updated, replacement
+
+# Batch generation settings
+BATCH_MAX_TRIPS = int(os.getenv("BATCH_MAX_TRIPS", 500))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 8))
+BATCH_RATE_LIMIT = float(os.getenv("BATCH_RATE_LIMIT", 2))  # upstream calls per second, 0 for no limit
+
+# Token bucket limiting how fast batch work may start upstream calls
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Block until `tokens` calls may start
+    def acquire(self, tokens=1):
+        if self.rate <= 0:
+            return
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_for = (tokens - self._tokens) / self.rate
+            time.sleep(wait_for)
+
+batch_rate_limiter = RateLimiter(BATCH_RATE_LIMIT)
+
+# Generate one batch item; waits for rate-limit headroom first so a batch never floods Gemini
+def run_batch_item(index, data, client):
+    try:
+        data = data if isinstance(data, dict) else {}
+        trip = parse_trip(data)
+        meter = request_meter("generation", trip, data, client=client)
+        trip = cap_trip_days(trip, meter)
+
+        # Only trips that reach Gemini wait for rate-limit tokens; cached and coalesced ones don't
+        def wait_for_capacity():
+            batch_rate_limiter.acquire(len(plan_chunks(trip)))
+            time.sleep(gemini_client.throttle_delay())
+
+        itinerary, cache_status = build_itinerary(trip, meter, before_generate=wait_for_capacity)
+        return {
+            "type": "result",
+            "index": index,
+            "id": save_itinerary(itinerary, trip),
+            "itinerary": itinerary,
+            "cached": cache_status == "HIT",
+            **usage_fields(trip, meter),
+        }
+    except Exception as e:
+        print(f"Batch item {index} failed: {e}")
+        return {"type": "error", "index": index, "error": str(e)}
+
+# Background job settings
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_DEPTH = int(os.getenv("JOB_QUEUE_DEPTH", 32))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 15 * 60))  # seconds
+
+# Raised when the job queue cannot take more work
+class QueueFullError(Exception):
+    pass
+
+# A unit of background work; partial holds results published before the job finishes
+class Job:
+    def __init__(self, fn, args):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.args = args
+        self.status = "queued"
+        self.partial = []
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self, since=0):
+        job = {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "completed": len(self.partial),
+            "partial": self.partial[since:],
+        }
+        if self.progress is not None:
+            job["progress"] = dict(self.progress)
+        if self.status == "done":
+            job["result"] = self.result
+        elif self.status == "failed":
+            job["error"] = self.error
+        return job
+
+# In-process job queue served by a fixed pool of worker threads. Routes only use
+# submit(), get() and stats(), so it can be swapped for a broker-backed queue later.
+class InProcessJobQueue:
+    def __init__(self, workers=JOB_WORKERS, depth=JOB_QUEUE_DEPTH, result_ttl=JOB_RESULT_TTL, name="job"):
+        self.workers = workers
+        self.name = name
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=depth)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    # Queue fn(job, *args) and return the job; raises QueueFullError instead of waiting.
+    # Workers start with the first job, not at import.
+    def submit(self, fn, *args):
+        with self._lock:
+            if not self._started:
+                for i in range(self.workers):
+                    threading.Thread(target=self._work, name=f"{self.name}-worker-{i}", daemon=True).start()
+                self._started = True
+        job = Job(fn, args)
+        self._evict_finished()
         try:
-            # Extract text from Gemini 2.0 response format
-            text_response = result["candidates"][0]["content"]["parts"][0]["text"]
-            print("Raw API response:", text_response)  # Debugging
-            
-            itinerary_json = parse_itinerary_to_json(text_response)
-            print("Parsed JSON:", itinerary_json)  # Debugging
-            
-            # Save the itinerary to a file (for debugging)
-            with open('itinerary.json', 'w') as f:
-                json.dump(itinerary_json, f, indent=2)
-                
-            return jsonify({"itinerary": itinerary_json})
-            
-        except Exception as e:
-            print(f"Error processing API response: {e}")
-            print(f"Response structure: {json.dumps(result, indent=2)}")
-            return jsonify({"error": f"Failed to process itinerary: {str(e)}"}), 500
-            
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError("Job queue is full")
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            "workers": self.workers,
+            "max_depth": self._queue.maxsize,
+            "queued": self._queue.qsize(),
+            "running": statuses.count("running"),
+            "done": statuses.count("done"),
+            "failed": statuses.count("failed"),
+        }
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            try:
+                job.result = job.fn(job, *job.args)
+                job.status = "done"
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            job.finished_at = time.time()
+            self._queue.task_done()
+
+    # Forget finished jobs whose results have not been collected in time
+    def _evict_finished(self):
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+job_queue = InProcessJobQueue()
+
+# Background generation; each day is published on the job as soon as it is parsed
+def run_generation_job(job, trip, meter):
+    cache_status = "MISS"
+    for day, cache_status in stream_itinerary_days(trip, meter):
+        job.partial.append(day)
+    itinerary = list(job.partial)
+    return {"id": save_itinerary(itinerary, trip), "itinerary": itinerary, "cached": cache_status == "HIT",
+            **usage_fields(trip, meter)}
+
+@app.route('/api/itinerary/generate', methods=['POST'])
+def generate_itinerary():
+    try:
+        data = request.json
+        trip = parse_trip(data)
+        meter = request_meter("generation", trip, data)
+        trip = cap_trip_days(trip, meter)
+        if data.get('async') or request.args.get('async') in ('1', 'true'):
+            return submit_generation_job(trip, meter)
+
+        itinerary_json, cache_status = build_itinerary(trip, meter)
+
+        itinerary_id = save_itinerary(itinerary_json, trip)
+
+        response = jsonify({"id": itinerary_id, "itinerary": itinerary_json, "cached": cache_status == "HIT",
+                            **usage_fields(trip, meter)})
+        response.headers["X-Cache"] = cache_status
+        return response
+
+    except InvalidTripError as e:
+        return jsonify({"error": str(e)}), 400
+    except TokenBudgetExceeded as e:
+        return budget_response(e)
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    except ValueError as e:
+        print(f"Error processing API response: {e}")
+        return jsonify({"error": f"Failed to process itinerary: {str(e)}"}), 500
     except Exception as e:
         print(f"Error generating itinerary: {e}")
         return jsonify({"error": f"Failed to generate itinerary: {str(e)}"}), 500
 
+# Gemini's circuit is open: answer at once and tell the client when to come back
+def unavailable_response(e):
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = str(max(1, round(e.retry_after)))
+    return response, 503
+
+# Queue the generation and return a job id straight away
+def submit_generation_job(trip, meter):
+    try:
+        job = job_queue.submit(run_generation_job, trip, meter)
+    except QueueFullError:
+        response = jsonify({"error": "Too many itineraries are being generated, please retry shortly"})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+
+    status_url = f"/api/itinerary/jobs/{job.id}"
+    response = jsonify({"job_id": job.id, "status": job.status, "status_url": status_url})
+    response.headers["Location"] = status_url
+    return response, 202
+
+# Poll a background job; ?since=N returns only the partial days after the first N
+@app.route('/api/itinerary/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id) or export_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    since = request.args.get('since', default=0, type=int)
+    return jsonify(job.to_dict(since=max(since, 0)))
+
+# Bulk export settings
+EXPORT_DIR = os.path.abspath(os.getenv("EXPORT_DIR", "exports"))  # absolute for send_file, like EXPORT_CACHE_DIR
+EXPORT_PROCESSES = int(os.getenv("EXPORT_PROCESSES", os.cpu_count() or 2))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 25))  # itineraries per worker task
+EXPORT_MAX_PENDING = EXPORT_PROCESSES * 2  # batches in flight; bounds memory held for the ZIP writer
+EXPORT_RESULT_TTL = int(os.getenv("EXPORT_RESULT_TTL", 24 * 60 * 60))  # seconds archives are kept
+EXPORT_MAX_ERRORS = 100  # per-itinerary errors listed in a job's result
+EXPORT_JOB_WORKERS = int(os.getenv("EXPORT_JOB_WORKERS", 2))  # exports running at once; each uses the whole pool
+EXPORT_QUEUE_DEPTH = int(os.getenv("EXPORT_QUEUE_DEPTH", 8))
+
+# Exports wait on the process pool for a long time, so they get their own queue and never
+# hold the workers that run async itinerary generation
+export_queue = InProcessJobQueue(EXPORT_JOB_WORKERS, EXPORT_QUEUE_DEPTH, name="export")
+
+export_pool = None
+export_pool_lock = threading.Lock()
+
+# Rendering is CPU-bound and FPDF holds the GIL, so exports fan out to worker processes.
+# They are spawned rather than forked because this process has running threads. Spawned
+# workers re-import the main module, which is server.py under `python server.py`; that is
+# why the store and job queues start their threads on first use instead of at import.
+def get_export_pool():
+    global export_pool
+    with export_pool_lock:
+        if export_pool is None:
+            export_pool = ProcessPoolExecutor(max_workers=EXPORT_PROCESSES,
+                                              mp_context=multiprocessing.get_context("spawn"))
+        return export_pool
+
+# Drop a pool whose worker died so the next export starts a fresh one
+def discard_export_pool(pool):
+    global export_pool
+    with export_pool_lock:
+        if export_pool is pool:
+            export_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def export_archive_path(job_id):
+    return os.path.join(EXPORT_DIR, f"{job_id}.zip")
+
+# Remove archives nobody downloaded in time
+def remove_old_exports():
+    cutoff = time.time() - EXPORT_RESULT_TTL
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+# Saved itineraries in batches as (records, ids not found): the given ids, or the whole
+# store by keyset pagination
+def export_batches(ids):
+    if ids is None:
+        for records in itinerary_store.iter_records(EXPORT_BATCH_SIZE):
+            yield records, []
+        return
+    for start in range(0, len(ids), EXPORT_BATCH_SIZE):
+        batch = ids[start:start + EXPORT_BATCH_SIZE]
+        records = [itinerary_store.get(itinerary_id) for itinerary_id in batch]
+        yield ([record for record in records if record is not None],
+               [itinerary_id for itinerary_id, record in zip(batch, records) if record is None])
+
+# Background bulk export. Batches render in the process pool while this thread appends
+# finished files to a ZIP on disk, so only a few batches are ever held in memory.
+def run_export_job(job, formats, ids, travel_style):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    remove_old_exports()
+    itinerary_store.flush()
+    job.progress = {
+        "total": len(ids) if ids is not None else itinerary_store.count(),
+        "exported": 0,
+        "files": 0,
+        "failed": 0,
+        "bytes": 0,
+        "elapsed_seconds": 0.0,
+        "itineraries_per_second": 0.0,
+    }
+    started = time.perf_counter()
+    errors = []
+    pool = get_export_pool()
+    pending = {}  # future -> number of itineraries in its batch
+    path = export_archive_path(job.id)
+    tmp_path = f"{path}.tmp"
+
+    try:
+        with zipfile.ZipFile(tmp_path, "w") as archive:
+            # Write out finished batches and update the job's progress
+            def collect():
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_size = pending.pop(future)
+                    files, failures = future.result()
+                    for name, data in files:
+                        # PDFs are already compressed; JSON and ICS shrink well
+                        compression = zipfile.ZIP_STORED if name.endswith(".pdf") else zipfile.ZIP_DEFLATED
+                        archive.writestr(name, data, compress_type=compression)
+                        EXPORTED_FILES.inc(format=name.rsplit(".", 1)[-1])
+                        job.progress["bytes"] += len(data)
+                    errors.extend(failures[:max(0, EXPORT_MAX_ERRORS - len(errors))])
+                    failed = len({record_id for record_id, _ in failures})
+                    elapsed = time.perf_counter() - started
+                    job.progress["exported"] += batch_size - failed
+                    job.progress["failed"] += failed
+                    job.progress["files"] += len(files)
+                    job.progress["elapsed_seconds"] = round(elapsed, 2)
+                    job.progress["itineraries_per_second"] = round(
+                        (job.progress["exported"] + job.progress["failed"]) / elapsed, 2)
+
+            for records, missing in export_batches(ids):
+                errors.extend((record_id, "Itinerary not found")
+                              for record_id in missing[:max(0, EXPORT_MAX_ERRORS - len(errors))])
+                job.progress["failed"] += len(missing)
+                if records:
+                    pending[pool.submit(render_export_batch, records, formats, travel_style)] = len(records)
+                if len(pending) >= EXPORT_MAX_PENDING:
+                    collect()
+            while pending:
+                collect()
+
+        os.replace(tmp_path, path)
+    except BrokenProcessPool:
+        discard_export_pool(pool)
+        raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {
+        "download_url": f"/api/itinerary/export/{job.id}.zip",
+        "formats": formats,
+        "errors": [{"id": record_id, "error": error} for record_id, error in errors],
+        **job.progress,
+    }
+
+# Export saved itineraries (all, or the given ids) as PDF, JSON and/or ICS files in one ZIP
+@app.route('/api/itinerary/export', methods=['POST'])
+def export_itineraries():
+    data = request.json or {}
+    formats = data.get('formats') or list(EXPORT_FORMATS)
+    if not isinstance(formats, list) or not formats or any(fmt not in EXPORT_FORMATS for fmt in formats):
+        return jsonify({"error": f"formats must be a list drawn from {', '.join(EXPORT_FORMATS)}"}), 400
+    ids = data.get('ids')
+    if ids is not None and (not isinstance(ids, list) or not all(isinstance(i, str) for i in ids)):
+        return jsonify({"error": "ids must be a list of itinerary ids"}), 400
+
+    try:
+        job = export_queue.submit(run_export_job, list(dict.fromkeys(formats)), ids, data.get('style'))
+    except QueueFullError:
+        response = jsonify({"error": "Too many exports are running, please retry shortly"})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+
+    status_url = f"/api/itinerary/jobs/{job.id}"
+    response = jsonify({"job_id": job.id, "status": job.status, "status_url": status_url})
+    response.headers["Location"] = status_url
+    return response, 202
+
+# Download a finished export
+@app.route('/api/itinerary/export/<job_id>.zip', methods=['GET'])
+def download_export(job_id):
+    path = export_archive_path(job_id)
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id) or not os.path.exists(path):
+        job = export_queue.get(job_id)
+        if job is not None and job.status in ("queued", "running"):
+            return jsonify({"error": "Export is still running", "status_url": f"/api/itinerary/jobs/{job_id}"}), 409
+        return jsonify({"error": "Export not found"}), 404
+    return send_file(path, mimetype="application/zip", as_attachment=True,
+                     download_name=f"wanderai_export_{job_id[:8]}.zip")
+
+# Regenerate one day or activity of a saved itinerary and save the result in place
+@app.route('/api/itinerary/<itinerary_id>/regenerate', methods=['POST'])
+def regenerate_saved_itinerary(itinerary_id):
+    record = itinerary_store.get(itinerary_id)
+    if record is None:
+        return jsonify({"error": "Itinerary not found"}), 404
+    return handle_regeneration(request.json or {}, record, itinerary_id)
+
+# Regenerate part of an itinerary sent in the request body; nothing is saved
+@app.route('/api/itinerary/regenerate', methods=['POST'])
+def regenerate_itinerary():
+    data = request.json or {}
+    if not isinstance(data.get('itinerary'), list):
+        return jsonify({"error": "An itinerary list or a saved itinerary id is required"}), 400
+    return handle_regeneration(data, data, None)
+
+def handle_regeneration(data, trip, itinerary_id):
+    try:
+        day_number = int(data.get('day'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "day must be a day number starting at 1"}), 400
+
+    try:
+        # The meter needs a validated day count; an inline itinerary's num_days is whatever was sent
+        num_days = trip.get('num_days')
+        num_days = parse_num_days(num_days) if num_days is not None else None
+        meter = request_meter("regeneration", dict(trip, num_days=num_days), data)
+        itinerary, replacement = regenerate_part(
+            trip, trip['itinerary'], day_number, data.get('slot'), data.get('instruction'), meter=meter,
+        )
+    except (LookupError, InvalidTripError) as e:
+        return jsonify({"error": str(e)}), 400
+    except TokenBudgetExceeded as e:
+        return budget_response(e)
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    except ValueError as e:
+        print(f"Error processing API response: {e}")
+        return jsonify({"error": f"Failed to process itinerary: {str(e)}"}), 500
+    except Exception as e:
+        print(f"Error regenerating itinerary: {e}")
+        return jsonify({"error": f"Failed to regenerate itinerary: {str(e)}"}), 500
+
+    if itinerary_id is not None:
+        itinerary_store.update(itinerary_id, itinerary)
+    return jsonify({"id": itinerary_id, "itinerary": itinerary, "replaced": replacement, **usage_fields(trip, meter)})
+
+# Generate many trips in one request; each result is streamed back as an NDJSON line when it completes
+@app.route('/api/itinerary/batch', methods=['POST'])
+def generate_batch():
+    data = request.json or {}
+    trips = data.get('trips')
+    if not isinstance(trips, list) or not trips:
+        return jsonify({"error": "trips must be a non-empty list"}), 400
+    if len(trips) > BATCH_MAX_TRIPS:
+        return jsonify({"error": f"Batches are limited to {BATCH_MAX_TRIPS} trips"}), 400
+    try:
+        concurrency = int(request.args.get('concurrency', data.get('concurrency', 4)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be an integer"}), 400
+    concurrency = min(max(concurrency, 1), BATCH_MAX_CONCURRENCY)
+    client = request_client()
+    try:
+        usage_tracker.check_client(client)
+    except TokenBudgetExceeded as e:
+        return budget_response(e)
+
+    def results():
+        succeeded = 0
+        started = time.monotonic()
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+        try:
+            futures = [pool.submit(run_batch_item, index, trip, client) for index, trip in enumerate(trips)]
+            for future in as_completed(futures):
+                result = future.result()
+                succeeded += result["type"] == "result"
+                yield json.dumps(result) + "\n"
+        finally:
+            # A client that disconnects mid-batch should not keep generating
+            pool.shutdown(wait=False, cancel_futures=True)
+        yield json.dumps({
+            "type": "done",
+            "total": len(trips),
+            "succeeded": succeeded,
+            "failed": len(trips) - succeeded,
+            "seconds": round(time.monotonic() - started, 2),
+        }) + "\n"
+
+    response = Response(stream_with_context(results()), mimetype="application/x-ndjson")
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# Stream the itinerary day by day, as NDJSON by default or as server-sent events
+@app.route('/api/itinerary/generate/stream', methods=['POST'])
+def generate_itinerary_stream():
+    try:
+        data = request.json or {}
+        trip = parse_trip(data)
+        meter = request_meter("generation", trip, data)
+        trip = cap_trip_days(trip, meter)
+    except InvalidTripError as e:
+        return jsonify({"error": str(e)}), 400
+    except TokenBudgetExceeded as e:
+        return budget_response(e)
+    use_sse = request.args.get("format") == "sse" or "text/event-stream" in request.headers.get("Accept", "")
+
+    def encode(event):
+        if use_sse:
+            return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        return json.dumps(event) + "\n"
+
+    def events():
+        days = []
+        cache_status = "MISS"
+        try:
+            for day, cache_status in stream_itinerary_days(trip, meter):
+                yield encode({"type": "day", "index": len(days), "data": day})
+                days.append(day)
+            itinerary_id = save_itinerary(days, trip)
+            yield encode({"type": "done", "id": itinerary_id, "count": len(days), "cached": cache_status == "HIT",
+                          **usage_fields(trip, meter)})
+        except Exception as e:
+            # Headers are already sent, so errors are reported in-band
+            print(f"Error streaming itinerary: {e}")
+            yield encode({"type": "error", "error": f"Failed to generate itinerary: {str(e)}"})
+
+    mimetype = "text/event-stream" if use_sse else "application/x-ndjson"
+    response = Response(stream_with_context(events()), mimetype=mimetype)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# Scrape-time gauges for state owned by other components
+REGISTRY.gauge("wanderai_cache_entries", "Itineraries held in the result cache",
+               function=lambda: itinerary_cache.stats()["entries"])
+REGISTRY.gauge("wanderai_generations_in_flight", "Distinct upstream generations in progress",
+               function=lambda: generation_flights.stats()["in_flight"])
+REGISTRY.gauge("wanderai_job_queue_depth", "Background jobs waiting for a worker",
+               function=lambda: job_queue.stats()["queued"])
+REGISTRY.gauge("wanderai_circuit_state", "Circuit breaker state per dependency (0 closed, 1 half-open, 2 open)",
+               ["dependency"], function=lambda: {name: STATE_VALUES[b["state"]] for name, b in BREAKERS.snapshot().items()})
+REGISTRY.gauge("wanderai_circuit_rejected_calls", "Calls failed fast by an open circuit since start",
+               ["dependency"], function=lambda: {name: b["rejected"] for name, b in BREAKERS.snapshot().items()})
+
+# Prometheus text exposition
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# Token usage and estimated cost, overall and by kind of call, destination, trip length and
+# client; ?client=ID shows the caller's own usage and allowance instead
+@app.route('/api/usage', methods=['GET'])
+def get_usage():
+    client = request.args.get('client')
+    if client:
+        if client != request_client():
+            return jsonify({"error": "Only your own usage can be looked up"}), 403
+        return jsonify(usage_tracker.client_snapshot(client))
+    return jsonify({
+        **usage_tracker.snapshot(),
+        "limits": {
+            "request_tokens": USAGE_REQUEST_TOKEN_LIMIT or None,
+            "client_tokens": usage_tracker.client_limit or None,
+            "client_window_seconds": usage_tracker.window,
+        },
+        "pricing": {"input_per_million": GEMINI_INPUT_PRICE, "output_per_million": GEMINI_OUTPUT_PRICE},
+    })
+
+# Usage of Gemini calls the app makes itself (the travel assistant), counted against the
+# session's allowance; returns what the session has left. Only the app may report usage.
+@app.route('/api/usage', methods=['POST'])
+def report_usage():
+    if not from_app():
+        return jsonify({"error": "Usage can only be reported by the app"}), 401
+    data = request.json or {}
+    try:
+        prompt_tokens = int(data.get('prompt_tokens') or 0)
+        output_tokens = int(data.get('output_tokens') or 0)
+        seconds = float(data.get('seconds') or 0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "prompt_tokens, output_tokens and seconds must be numbers"}), 400
+    try:
+        num_days = parse_num_days(data['num_days']) if data.get('num_days') is not None else None
+    except InvalidTripError as e:
+        return jsonify({"error": str(e)}), 400
+    if min(prompt_tokens, output_tokens, seconds) < 0:
+        return jsonify({"error": "prompt_tokens, output_tokens and seconds cannot be negative"}), 400
+    if prompt_tokens + output_tokens > USAGE_REPORT_MAX_TOKENS:
+        return jsonify({"error": f"A single report is limited to {USAGE_REPORT_MAX_TOKENS} tokens"}), 400
+
+    client = request_client()
+    if data.get('client') not in (None, client):
+        return jsonify({"error": "Usage can only be reported for the calling client"}), 403
+    meter = UsageMeter(usage_tracker, "assistant", data.get('destination'), num_days, client)
+    record_usage(meter, {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens}, seconds)
+    return jsonify({
+        "client": client,
+        "remaining_tokens": usage_tracker.client_remaining(client),
+        "resets_in": usage_tracker.client_snapshot(client)["window_resets_in"],
+    })
+
+# Runtime statistics for the server's caches
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    return jsonify({
+        "cache": itinerary_cache.stats(),
+        "coalescing": generation_flights.stats(),
+        "jobs": job_queue.stats(),
+        "export_jobs": export_queue.stats(),
+        "exports": export_cache.stats(),
+        "circuits": BREAKERS.snapshot(),
+        "usage": usage_tracker.snapshot()["totals"],
+    })
+
 # Run the Flask app
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))  
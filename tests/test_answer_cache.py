@@ -0,0 +1,42 @@
+from answer_cache import AnswerCache, normalize_question
+
+
+def cached_answer(asked, question, others=()):
+    cache = AnswerCache()
+    for other in others:
+        cache.put("paris", other, "other answer")
+    cache.put("paris", asked, "answer")
+    return cache.get("paris", question)
+
+
+def test_paraphrases_share_an_answer():
+    hit = cached_answer("What's the best time to visit the Eiffel Tower?", "When should I go to the Eiffel Tower?")
+    assert hit["answer"] == "answer"
+
+
+def test_negation_is_not_a_paraphrase():
+    asked = "Is it safe to walk around Montmartre at night with kids?"
+    assert cached_answer(asked, "Is it not safe to walk around Montmartre at night with kids?") is None
+    assert cached_answer(asked, "Isn't it safe to walk around Montmartre at night with kids?") is None
+    assert cached_answer(asked, "Is it safe to walk around Montmartre at night with kids")["answer"] == "answer"
+
+
+def test_named_places_must_match():
+    asked = "How long does the RER train take from CDG airport to the city centre?"
+    assert cached_answer(asked, "How long does the RER train take from Orly airport to the city centre?") is None
+    assert cached_answer("What to do on day 2", "What to do on day 3") is None
+
+
+def test_rare_words_outweigh_common_ones():
+    # Unweighted, these two share 70% of their shingles; the airport names are what differ
+    question = "how long does the express train take from %s airport to the city center with luggage"
+    others = ["How long does the express train take from the airport to the Louvre?",
+              "How long does the express train take to Versailles with luggage?",
+              "How long does the train take from the airport to the city center?"]
+    assert cached_answer(question % "cdg", question % "orly", others) is None
+    assert cached_answer(question % "cdg", question % "cdg", others)["answer"] == "answer"
+
+
+def test_plural_rule_keeps_names():
+    assert normalize_question("Best day trips from Paris")[0] == ["best", "day", "trip", "paris"]
+    assert normalize_question("Is the Louvre open on Mondays?") == (["louvre", "open", "monday"], {"louvre", "monday"})
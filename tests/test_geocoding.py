@@ -0,0 +1,20 @@
+from geocoding import extract_activity_places
+
+
+def test_names_from_the_pattern_comment():
+    assert extract_activity_places("Visit Café de Flore, then the Musée d'Orsay") == ["Café de Flore", "Musée d'Orsay"]
+    assert extract_activity_places("Visit the Tower of London") == ["Tower of London"]
+    assert extract_activity_places("Stroll across Île de la Cité at dusk") == ["Île de la Cité"]
+
+
+def test_names_stop_at_sentence_ends():
+    text = "Stroll around Montmartre. Explore Sacré-Cœur Basilica at sunset."
+    assert extract_activity_places(text) == ["Montmartre", "Sacré-Cœur Basilica"]
+
+
+def test_abbreviations_keep_their_period():
+    assert extract_activity_places("Visit St. Paul's Cathedral") == ["St. Paul's Cathedral"]
+
+
+def test_destination_is_skipped():
+    assert extract_activity_places("Walk along the Seine in Paris", destination="Paris, France") == ["Seine"]
@@ -0,0 +1,30 @@
+import random
+
+from routing import day_distance, order_day, optimize_itinerary
+
+
+def test_optimized_days_are_never_longer():
+    rng = random.Random(7)
+    for _ in range(2000):
+        count = rng.randint(3, 9)
+        positions = [(48.8 + rng.random() * 0.1, 2.3 + rng.random() * 0.1) if rng.random() > 0.1 else None
+                     for _ in range(count)]
+        fixed = [rng.random() < 0.2 for _ in range(count)]
+        order = order_day(positions, fixed)
+        before = day_distance(positions)
+        after = day_distance([positions[source] for source in order])
+        assert after <= before + 1e-9
+        if after >= before - 1e-9:
+            assert order == list(range(count))
+
+
+def test_short_route_keeps_its_order():
+    itinerary = [{"day": "Day 1", "activities": [
+        {"time": "Morning", "activity": "Louvre"},
+        {"time": "Afternoon", "activity": "Tuileries"},
+        {"time": "Evening", "activity": "Place de la Concorde"},
+    ]}]
+    stops = [{"day": 1, "activity_index": i, "lat": 48.86, "lon": 2.33 - 0.01 * i} for i in range(3)]
+    optimized, report = optimize_itinerary(itinerary, stops)
+    assert optimized == itinerary
+    assert report["after_km"] == report["before_km"]
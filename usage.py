@@ -0,0 +1,247 @@
+# Token usage and cost accounting for Gemini calls.
+#
+# Each call's usageMetadata is recorded against the kind of call (generation, regeneration,
+# assistant), the trip's destination and day count, and the client that asked for it, and
+# totals are kept per dimension for /api/usage. Each client's recent tokens are also kept
+# in a rolling window so a per-client ceiling can be enforced. A UsageMeter follows one
+# request through its model calls and stops it once it has spent its token budget.
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Prices in USD per million tokens (gemini-2.5-flash list prices); thinking tokens bill as output
+GEMINI_INPUT_PRICE = float(os.getenv("GEMINI_INPUT_PRICE", 0.30))
+GEMINI_OUTPUT_PRICE = float(os.getenv("GEMINI_OUTPUT_PRICE", 2.50))
+
+# Token ceilings; 0 turns a ceiling off
+USAGE_REQUEST_TOKEN_LIMIT = int(os.getenv("USAGE_REQUEST_TOKEN_LIMIT", 0))  # per request
+USAGE_CLIENT_TOKEN_LIMIT = int(os.getenv("USAGE_CLIENT_TOKEN_LIMIT", 0))  # per client per window
+USAGE_CLIENT_WINDOW = int(os.getenv("USAGE_CLIENT_WINDOW", 24 * 60 * 60))  # seconds
+USAGE_MAX_KEYS = 500  # distinct values tracked per dimension; later ones are counted under "other"
+USAGE_MAX_WINDOW_CLIENTS = int(os.getenv("USAGE_MAX_WINDOW_CLIENTS", 10000))  # least recently active dropped first
+
+DEFAULT_TOKENS_PER_DAY = 1500  # estimated tokens to generate one day, until there is history
+MIN_DAYS_FOR_ESTIMATE = 20  # generated days needed before the measured rate is used
+CHARS_PER_TOKEN = 4
+
+DIMENSIONS = ("kind", "destination", "num_days", "client")
+
+
+# Raised when a request or client has used up its tokens; retry_after is set for client windows
+class TokenBudgetExceeded(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# (prompt tokens, output tokens) from a Gemini usageMetadata dict
+def usage_from_metadata(metadata):
+    metadata = metadata or {}
+    prompt_tokens = int(metadata.get("promptTokenCount") or 0)
+    output_tokens = int(metadata.get("candidatesTokenCount") or 0) + int(metadata.get("thoughtsTokenCount") or 0)
+    return prompt_tokens, output_tokens
+
+
+def estimate_cost(prompt_tokens, output_tokens):
+    return (prompt_tokens * GEMINI_INPUT_PRICE + output_tokens * GEMINI_OUTPUT_PRICE) / 1_000_000
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _bucket():
+    return {"calls": 0, "prompt_tokens": 0, "output_tokens": 0, "cost_usd": 0.0, "seconds": 0.0}
+
+
+def _summary(bucket):
+    calls = bucket["calls"]
+    return {
+        "calls": calls,
+        "prompt_tokens": bucket["prompt_tokens"],
+        "output_tokens": bucket["output_tokens"],
+        "total_tokens": bucket["prompt_tokens"] + bucket["output_tokens"],
+        "cost_usd": round(bucket["cost_usd"], 6),
+        "avg_tokens": round((bucket["prompt_tokens"] + bucket["output_tokens"]) / calls, 1) if calls else 0.0,
+        "avg_seconds": round(bucket["seconds"] / calls, 3) if calls else 0.0,
+    }
+
+
+class UsageTracker:
+    def __init__(self, client_limit=USAGE_CLIENT_TOKEN_LIMIT, window=USAGE_CLIENT_WINDOW, max_keys=USAGE_MAX_KEYS,
+                 max_window_clients=USAGE_MAX_WINDOW_CLIENTS):
+        self.client_limit = client_limit
+        self.window = window
+        self.max_keys = max_keys
+        self.max_window_clients = max_window_clients
+        self._totals = _bucket()
+        self._by = {dimension: {} for dimension in DIMENSIONS}
+        # client -> deque of (time, tokens) inside the window, least recently active first; only
+        # kept while there is a client ceiling to enforce
+        self._recent = OrderedDict()
+        self._generated_days = 0
+        self._generation_tokens = 0
+        self._lock = threading.Lock()
+
+    # Record one model call. days is how many itinerary days the call generated, used to
+    # estimate what a trip of a given length will cost.
+    def record(self, kind, prompt_tokens, output_tokens, seconds, destination=None, num_days=None, client=None, days=0):
+        tokens = prompt_tokens + output_tokens
+        cost = estimate_cost(prompt_tokens, output_tokens)
+        labels = {
+            "kind": kind,
+            "destination": " ".join(str(destination or "unknown").lower().split()),
+            "num_days": str(num_days or "unknown"),
+            "client": client or "unknown",
+        }
+        with self._lock:
+            buckets = [self._totals]
+            for dimension, value in labels.items():
+                by_value = self._by[dimension]
+                if value not in by_value and len(by_value) >= self.max_keys:
+                    value = "other"
+                buckets.append(by_value.setdefault(value, _bucket()))
+            for bucket in buckets:
+                bucket["calls"] += 1
+                bucket["prompt_tokens"] += prompt_tokens
+                bucket["output_tokens"] += output_tokens
+                bucket["cost_usd"] += cost
+                bucket["seconds"] += seconds
+            if days:
+                self._generated_days += days
+                self._generation_tokens += tokens
+            if client and tokens and self.client_limit > 0:
+                self._recent.setdefault(client, deque()).append((time.time(), tokens))
+                self._recent.move_to_end(client)
+                while len(self._recent) > self.max_window_clients:
+                    self._recent.popitem(last=False)
+
+    # Average tokens spent per generated day
+    def tokens_per_day(self):
+        with self._lock:
+            if self._generated_days < MIN_DAYS_FOR_ESTIMATE:
+                return DEFAULT_TOKENS_PER_DAY
+            return max(1, self._generation_tokens // self._generated_days)
+
+    # Tokens the client used inside the window and when the oldest of them expires
+    def _client_usage(self, client):
+        recent = self._recent.get(client)
+        if not recent:
+            return 0, None
+        cutoff = time.time() - self.window
+        while recent and recent[0][0] <= cutoff:
+            recent.popleft()
+        if not recent:
+            del self._recent[client]
+            return 0, None
+        return sum(tokens for _, tokens in recent), recent[0][0] + self.window
+
+    # Tokens the client may still use in this window, or None when there is no client ceiling
+    def client_remaining(self, client):
+        if self.client_limit <= 0:
+            return None
+        with self._lock:
+            used, _ = self._client_usage(client)
+        return max(0, self.client_limit - used)
+
+    # Raise if the client has used up its tokens for this window
+    def check_client(self, client):
+        if self.client_limit <= 0:
+            return
+        with self._lock:
+            used, resets_at = self._client_usage(client)
+        if used >= self.client_limit:
+            raise TokenBudgetExceeded(
+                f"Token allowance of {self.client_limit} per {self.window // 3600}h used up",
+                retry_after=max(1.0, resets_at - time.time()),
+            )
+
+    def client_snapshot(self, client):
+        with self._lock:
+            used, resets_at = self._client_usage(client)
+            totals = self._by["client"].get(client)
+            return {
+                "client": client,
+                "window_seconds": self.window,
+                "window_tokens": used,
+                "window_limit": self.client_limit or None,
+                "window_resets_in": round(resets_at - time.time(), 1) if resets_at else None,
+                "totals": _summary(totals or _bucket()),
+            }
+
+    # Totals overall and per dimension value, most expensive first
+    def snapshot(self):
+        with self._lock:
+            snapshot = {"totals": _summary(self._totals)}
+            for dimension, by_value in self._by.items():
+                ranked = sorted(by_value.items(), key=lambda item: -item[1]["cost_usd"])
+                snapshot[f"by_{dimension}"] = {value: _summary(bucket) for value, bucket in ranked}
+            snapshot["tokens_per_day"] = (self._generation_tokens // self._generated_days
+                                          if self._generated_days >= MIN_DAYS_FOR_ESTIMATE else DEFAULT_TOKENS_PER_DAY)
+        return snapshot
+
+
+# Tokens used by one request across all its model calls, which may run in parallel. Each
+# call reserves its share of the budget before it starts, so calls in flight together can
+# never spend more than the request's limit between them.
+class UsageMeter:
+    def __init__(self, tracker, kind, destination=None, num_days=None, client=None, limit=None):
+        self.tracker = tracker
+        self.kind = kind
+        self.destination = destination
+        self.num_days = num_days
+        self.client = client
+        self.limit = limit  # tokens this request may use, None for no limit
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.days = 0  # itinerary days generated so far
+        self._reserved = 0  # tokens set aside for calls in flight
+        self._reserved_days = 0
+        self._lock = threading.Lock()
+
+    def used(self):
+        with self._lock:
+            return self.prompt_tokens + self.output_tokens
+
+    def remaining(self):
+        return None if self.limit is None else max(0, self.limit - self.used())
+
+    # Set aside tokens for a call and return its reservation, (tokens, days). A call that
+    # generates days gets the unreserved budget in proportion to its share of the days not yet
+    # generated or reserved; any other call gets all of it. Raises if the call's prompt alone
+    # would use up its share. Without a limit nothing is reserved.
+    def reserve(self, prompt, days=0):
+        if self.limit is None:
+            return 0, 0
+        with self._lock:
+            available = self.limit - self.prompt_tokens - self.output_tokens - self._reserved
+            pending_days = (self.num_days or 0) - self.days - self._reserved_days
+            tokens = available * days // pending_days if 0 < days < pending_days else available
+            if tokens - estimate_tokens(prompt) <= 0:
+                raise TokenBudgetExceeded(f"Request token budget of {self.limit} used up "
+                                          f"({self.prompt_tokens + self.output_tokens} used, {self._reserved} reserved)")
+            self._reserved += tokens
+            self._reserved_days += days
+        return tokens, days
+
+    # Cap for the maxOutputTokens of a call holding this reservation, None without a limit
+    def max_output_tokens(self, prompt, reservation):
+        return None if self.limit is None else reservation[0] - estimate_tokens(prompt)
+
+    # Give back a finished call's reservation; what it actually used is recorded separately
+    def release(self, reservation):
+        with self._lock:
+            self._reserved -= reservation[0]
+            self._reserved_days -= reservation[1]
+
+    # Add a finished call's usage to this request and the tracker; returns (prompt, output) tokens
+    def record(self, metadata, seconds, days=0):
+        prompt_tokens, output_tokens = usage_from_metadata(metadata)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.output_tokens += output_tokens
+            self.days += days
+        self.tracker.record(self.kind, prompt_tokens, output_tokens, seconds, destination=self.destination,
+                            num_days=self.num_days, client=self.client, days=days)
+        return prompt_tokens, output_tokens